@@ -0,0 +1,278 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+from src.Refinement import refiner
+from src.Scheduler import scheduler
+from src.Tracing import tracer
+from benchmarks.StandIns import (
+    DEFAULT_QUERIES, FakeAzureOpenAI, HashingEncoder, connect_in_memory_mongo,
+    serve_arxiv, synthetic_corpus, synthetic_graph
+)
+
+# Benchmark stage -> span emitted by src.Tracing
+STAGE_SPANS = {
+    "cache_lookup": "CacheHit",
+    "subqueries": "UserQuery.multi_query",
+    "retrieval": "ContextRetrieval.retrieve",
+    "arxiv": "DeepSearch.get_context",
+    "ranking": "ranking",
+    "context": "ContextBuilder.build",
+    "generation": "LLM.completion",
+    "evaluation": "Evaluation.evaluate",
+    "drafting": "Evaluation.drafting",
+    "refinement": "Evaluation.refine",
+    "cache_write": "save_to_cache",
+    "total_normal": "normal_search",
+    "total_deep": "deep_search"
+}
+
+class StageTimer:
+    """Collects span durations per benchmark stage while it is attached to the tracer"""
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.stages = {span_name: stage for stage, span_name in STAGE_SPANS.items()}
+
+    def record(self, span):
+        stage = self.stages.get(span.name)
+        if stage is not None:
+            with self.lock:
+                self.samples.setdefault(stage, []).append(span.duration * 1000)
+
+    @contextlib.contextmanager
+    def attached(self):
+        tracer.add_listener(self.record)
+        try:
+            yield self
+        finally:
+            tracer.remove_listener(self.record)
+
+    def summary(self):
+        summary = {}
+        for stage in STAGE_SPANS:
+            samples = self.samples.get(stage)
+            if samples:
+                summary[stage] = {
+                    'count': len(samples),
+                    'p50_ms': round(float(np.percentile(samples, 50)), 3),
+                    'p95_ms': round(float(np.percentile(samples, 95)), 3),
+                    'max_ms': round(float(np.max(samples)), 3)
+                }
+        return summary
+
+def build_corpus(work_dir, args, model):
+    import faiss
+    from src.CorpusStore import CorpusStore, convert_chunks
+    from src.EntityIndex import EntityIndex
+    from src.GraphStore import CSRGraph, convert_graph
+
+    chunks = synthetic_corpus(num_chunks=args.chunks)
+    convert_chunks(chunks, os.path.join(work_dir, "corpus"))
+    convert_graph(synthetic_graph(), os.path.join(work_dir, "knowledge_graph"))
+
+    vectors = np.asarray(model.encode([chunk['text'] for chunk in chunks]), dtype='float32')
+    faiss.normalize_L2(vectors)
+    vector_db = faiss.IndexFlatL2(vectors.shape[1])
+    vector_db.add(vectors)
+
+    if args.promote:
+        # Deep search papers are promoted into the corpus, later searches go through the PromotedIndex wrapper
+        import src.main as main
+        from src.CorpusPromoter import corpus_promoter, load_promoted_index
+        vector_db = load_promoted_index(vector_db, os.path.join(work_dir, "promoted.index"))
+        corpus_promoter.corpus_dir = os.path.join(work_dir, "corpus")
+        corpus_promoter.index_path = os.path.join(work_dir, "promoted.index")
+        main.promote_deep_search = True
+
+    dictionary = CorpusStore.load(os.path.join(work_dir, "corpus"))
+    return {
+        "vector_db": vector_db,
+        "dictionary": dictionary,
+        "entity_index": EntityIndex.build(dictionary),
+        "knowledge_graph": CSRGraph.load(os.path.join(work_dir, "knowledge_graph"))
+    }
+
+def install_stand_ins(work_dir, args):
+    from src.EmbeddingService import register_embedding_service
+    from src.Resources import resources
+
+    if args.real_model:
+        model = resources.get("model")
+    else:
+        model = HashingEncoder()
+        register_embedding_service(model, "hashing-encoder", max_batch_size=64, max_wait_ms=5)
+        resources.override("model", model)
+
+    if args.completions:
+        client = FakeAzureOpenAI.from_file(args.completions, latency_ms=args.llm_latency_ms, token_ms=args.token_ms)
+    else:
+        client = FakeAzureOpenAI(latency_ms=args.llm_latency_ms, token_ms=args.token_ms)
+    resources.override("client", client)
+    resources.override("mongo", connect_in_memory_mongo())
+
+    if not args.real_data:
+        for name, value in build_corpus(work_dir, args, model).items():
+            resources.override(name, value)
+    return model
+
+def reset_state(model, work_dir):
+    # Every run starts cold: empty answer cache, empty embedding LRU, fresh paper and LLM caches
+    from src.AnswerCache import answer_cache
+    from src.CacheDB import CacheDB
+    from src.CacheIndex import cache_index
+    from src.CacheWriter import cache_writer
+    from src.EmbeddingService import get_embedding_service
+    from src.LLMCache import llm_cache
+    from src.PaperCache import PaperCache
+    from src.Resources import resources
+
+    cache_writer.drain()
+    CacheDB.drop_collection()
+    cache_index.reset()
+    answer_cache.clear()
+    get_embedding_service(model).clear()
+    resources.override("paper_cache", PaperCache(tempfile.mkdtemp(prefix="papers-", dir=work_dir)))
+    llm_cache.reset(tempfile.mkdtemp(prefix="llm-", dir=work_dir))
+
+def run_searches(args, model, work_dir, iterations):
+    import src.main as main
+
+    searches = []
+    if args.mode in ("normal", "both"):
+        searches.append(("normal", lambda query: main.normal_search(query, 0.5)))
+    if args.mode in ("deep", "both"):
+        searches.append(("deep", lambda query: main.deep_search(query, 0.5)))
+
+    queries = DEFAULT_QUERIES[:args.queries]
+    for _ in range(iterations):
+        reset_state(model, work_dir)
+        for query in queries:
+            for mode, search in searches:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+                    answer = search(query)
+                if not answer:
+                    raise RuntimeError(f"{mode} search returned an empty answer for {query!r}")
+
+def measure_memory(args, model, work_dir):
+    # A separate traced pass, tracemalloc slows allocation heavy code and would skew the latencies
+    tracemalloc.start()
+    try:
+        run_searches(args, model, work_dir, 1)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'python_peak_mb': round(peak / 2**20, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    }
+
+def compare(results, baseline, tolerance, slack_ms):
+    failures = []
+    for stage, stats in baseline['stages'].items():
+        current = results['stages'].get(stage)
+        if current is None:
+            failures.append(f"{stage}: stage missing from this run")
+            continue
+        limit = stats['p50_ms'] * (1 + tolerance) + slack_ms
+        if current['p50_ms'] > limit:
+            failures.append(f"{stage}: p50 {current['p50_ms']:.1f} ms > {limit:.1f} ms (baseline {stats['p50_ms']:.1f} ms)")
+
+    baseline_memory = (baseline.get('memory') or {}).get('python_peak_mb')
+    current_memory = (results.get('memory') or {}).get('python_peak_mb')
+    if baseline_memory and current_memory and current_memory > baseline_memory * (1 + tolerance):
+        failures.append(f"python peak memory {current_memory:.1f} MB > {baseline_memory * (1 + tolerance):.1f} MB (baseline {baseline_memory:.1f} MB)")
+    return failures
+
+def print_report(results):
+    print(f"{'stage':<14}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}")
+    for stage, stats in results['stages'].items():
+        print(f"{stage:<14}{stats['count']:>7}{stats['p50_ms']:>11.2f}{stats['p95_ms']:>11.2f}{stats['max_ms']:>11.2f}")
+    if results.get('memory'):
+        print(f"python peak {results['memory']['python_peak_mb']} MB, max rss {results['memory']['max_rss_mb']} MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run normal and deep search end to end against local stand-ins and report per-stage latency.")
+    parser.add_argument("--mode", choices=["normal", "deep", "both"], default="both")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=len(DEFAULT_QUERIES))
+    parser.add_argument("--chunks", type=int, default=2000, help="size of the synthetic corpus")
+    parser.add_argument("--papers", default="papersfortesting", help="PDFs served by the local arXiv stand-in")
+    parser.add_argument("--completions", help="JSON file mapping FakeAzureOpenAI.key(messages) to recorded completions")
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--token-ms", type=float, default=0)
+    parser.add_argument("--real-model", action="store_true", help="use the sentence transformer instead of the hashing encoder")
+    parser.add_argument("--real-data", action="store_true", help="use the shipped index, corpus and graph instead of the synthetic corpus")
+    parser.add_argument("--promote", action="store_true", help="promote deep search papers into the synthetic corpus and search through the promoted index")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(__file__), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against the baseline")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="absolute allowance added to every stage limit")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced pass that measures peak memory")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output and every span histogram")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="mdds-bench-") as work_dir, serve_arxiv(args.papers) as arxiv_url:
+        # src.DeepSearch reads the endpoint at import time, so also repoint a module that is already loaded
+        os.environ["ARXIV_API_URL"] = f"{arxiv_url}/api/query"
+        import src.DeepSearch
+        src.DeepSearch.ARXIV_API_URL = os.environ["ARXIV_API_URL"]
+        model = install_stand_ins(work_dir, args)
+
+        # One untimed run so lazy loaders and imports do not land in the first sample
+        run_searches(args, model, work_dir, 1)
+        with StageTimer().attached() as timer:
+            run_searches(args, model, work_dir, args.iterations)
+        stages = timer.summary()
+        memory = None if args.no_memory else measure_memory(args, model, work_dir)
+
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline", "output", "verbose")},
+        'stages': stages,
+        'memory': memory
+    }
+    print_report(results)
+    if args.verbose:
+        print(tracer.report())
+        print(scheduler.report())
+        print(refiner.report())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get('config') != results['config']:
+        print("Warning: baseline was recorded with a different configuration")
+
+    failures = compare(results, baseline, args.tolerance, args.slack_ms)
+    if failures:
+        print("REGRESSION against baseline:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print("No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+import numpy as np
+
+MEDICAL_TERMS = [
+    "glucose", "insulin", "sensor", "monitor", "patch", "biosensor", "diabetes", "electrode",
+    "enzyme", "catheter", "stent", "pacemaker", "ultrasound", "imaging", "biopsy", "assay",
+    "antibody", "antigen", "troponin", "cardiac", "oximeter", "oxygen", "saturation", "blood",
+    "plasma", "serum", "sweat", "saliva", "microfluidic", "nanoparticle", "graphene", "polymer",
+    "wearable", "implant", "calibration", "accuracy", "sensitivity", "specificity", "biomarker", "sepsis",
+    "lactate", "cortisol", "creatinine", "hemoglobin", "thermometer", "ecg", "eeg", "spectroscopy",
+    "fluorescence", "impedance", "membrane", "hydrogel", "smartphone", "algorithm", "screening", "diagnosis",
+    "infection", "pathogen", "pcr", "cartridge", "device", "clinician", "patient", "trial"
+]
+FILLER_WORDS = [
+    "the", "a", "of", "in", "with", "for", "was", "were", "measured", "improved", "reported",
+    "compared", "using", "study", "results", "showed", "method", "clinical", "performance", "low"
+]
+DEFAULT_QUERIES = [
+    "Which wearable sensor measures glucose in sweat most accurately?",
+    "How do clinicians calibrate a continuous glucose monitor?",
+    "What biomarker detects sepsis earliest in blood?",
+    "Does a smartphone oximeter measure oxygen saturation reliably?",
+    "Which microfluidic cartridge performs PCR screening for infection?"
+]
+
+class HashingEncoder:
+    """Deterministic bag-of-words encoder with the SentenceTransformer.encode signature"""
+    def __init__(self, dimension=768):
+        self.dimension = dimension
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, digest % self.dimension] += 1.0 if digest >> 63 else -1.0
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors[0] if single else vectors
+
+class FakeAzureOpenAI:
+    """Replays recorded completions keyed by message hash and synthesizes the rest from the prompt"""
+    def __init__(self, recordings=None, latency_ms=0, token_ms=0):
+        self.recordings = recordings or {}
+        self.latency_ms = latency_ms
+        self.token_ms = token_ms
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, "r") as f:
+            return cls(json.load(f), **kwargs)
+
+    @staticmethod
+    def key(messages):
+        return hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def create(self, model=None, messages=None, temperature=None, stream=False, **kwargs):
+        with self.lock:
+            self.calls += 1
+        content = self.recordings.get(self.key(messages))
+        if content is None:
+            content = synthetic_completion(messages)
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+        return self.stream(content)
+
+    def stream(self, content):
+        # Azure sends a first chunk with no choices that only carries content filter results
+        yield SimpleNamespace(choices=[])
+        for token in re.findall(r"\S+\s*|\s+", content):
+            if self.token_ms:
+                time.sleep(self.token_ms / 1000)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+def synthetic_completion(messages):
+    system = messages[0]["content"]
+    prompt = messages[-1]["content"]
+
+    if "subqueries" in system:
+        question = prompt.split("The question to create subqueries based off of is:", 1)[-1].split("Return the output", 1)[0].strip()
+        terms = [word for word in re.findall(r"\w+", question.lower()) if word in MEDICAL_TERMS] or ["device"]
+        return "\n".join([
+            f"The {terms[0]} device improves patient diagnosis",
+            f"Clinicians measure {terms[-1]} accuracy with a sensor",
+            f"Studies compare {' '.join(terms)} performance"
+        ])
+
+    if "improved_answer" in prompt:
+        contents = re.findall(r"^Content: (.+)$", prompt, flags=re.MULTILINE)
+        titles = re.findall(r"title: ([^,\n]+)", prompt)
+        body = " ".join(content.strip() for content in contents[:3])
+        sources = "\n".join(f"{i}. {title}" for i, title in enumerate(dict.fromkeys(titles[:3]), 1))
+        return json.dumps({
+            "needs_grounding": True,
+            "needs_query_focus": False,
+            "insufficient_context": False,
+            "assessment_summary": "Cite the retrieved studies more directly",
+            "improved_answer": f"According to the retrieved studies, {body}\n\nSources:\n{sources}"
+        })
+
+    if "Return only valid JSON" in system:
+        return json.dumps({
+            "needs_grounding": True,
+            "needs_query_focus": False,
+            "insufficient_context": False,
+            "assessment_summary": "Cite the retrieved studies more directly"
+        })
+
+    # Answers quote the first sentences of the context and list its titles as sources
+    contents = re.findall(r"^Content: (.+)$", prompt, flags=re.MULTILINE) or re.findall(r"^- (.+)$", prompt, flags=re.MULTILINE)
+    titles = re.findall(r"title: ([^,\n]+)", prompt)
+    body = " ".join(content.split(". ")[0].strip() + "." for content in contents[:5])
+    sources = "\n".join(f"{i}. {title}" for i, title in enumerate(dict.fromkeys(titles[:5]), 1))
+    return f"Based on the retrieved studies, {body}\n\nSources:\n{sources}"
+
+def synthetic_corpus(num_chunks=2000, sentences_per_chunk=6, seed=7):
+    rng = np.random.default_rng(seed)
+    chunks = []
+    for i in range(num_chunks):
+        sentences = []
+        for _ in range(sentences_per_chunk):
+            words = list(rng.choice(MEDICAL_TERMS, 4)) + list(rng.choice(FILLER_WORDS, 6))
+            rng.shuffle(words)
+            sentences.append(" ".join(words).capitalize() + ".")
+        text = " ".join(sentences)
+        entities = sorted({word for word in re.findall(r"\w+", text.lower()) if word in MEDICAL_TERMS})
+        chunks.append({
+            'text': text,
+            'metadata': {
+                'title': f"Synthetic study {i // 4} of {entities[0] if entities else 'devices'}",
+                'authors': f"Author {i % 97}",
+                'year': str(2000 + i % 25)
+            },
+            'entities': entities
+        })
+    return chunks
+
+def synthetic_graph(seed=7, edges_per_node=6):
+    import networkx as nx
+    rng = np.random.default_rng(seed)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(MEDICAL_TERMS)
+    for term in MEDICAL_TERMS:
+        for neighbor in rng.choice(MEDICAL_TERMS, edges_per_node, replace=False):
+            if neighbor != term:
+                graph.add_edge(term, str(neighbor))
+    return graph
+
+class ArxivHandler(BaseHTTPRequestHandler):
+    paper_dir = None
+
+    def do_GET(self):
+        if self.path.startswith("/api/query"):
+            self.send_body(self.atom_feed().encode("utf-8"), "application/atom+xml")
+        elif self.path.startswith("/pdf/"):
+            path = os.path.join(self.paper_dir, os.path.basename(self.path[len("/pdf/"):]))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as f:
+                self.send_body(f.read(), "application/pdf")
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def atom_feed(self):
+        # Every query returns the same local papers so runs are reproducible
+        base_url = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+        entries = []
+        for name in sorted(os.listdir(self.paper_dir)):
+            if not name.endswith(".pdf"):
+                continue
+            arxiv_id = name[:-len(".pdf")]
+            entries.append(f"""  <entry>
+    <id>http://arxiv.org/abs/{escape(arxiv_id)}</id>
+    <published>2007-07-03T00:00:00Z</published>
+    <title>Local paper {escape(arxiv_id)}</title>
+    <summary>Paper served from {escape(name)} for offline benchmarks.</summary>
+    <author><name>Benchmark Author</name></author>
+    <link title="pdf" href="{base_url}/pdf/{escape(name)}" rel="related" type="application/pdf"/>
+  </entry>""")
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n' + "\n".join(entries) + "\n</feed>\n"
+
+    def log_message(self, format, *args):
+        pass
+
+@contextmanager
+def serve_arxiv(paper_dir="papersfortesting"):
+    handler = type("LocalArxivHandler", (ArxivHandler,), {"paper_dir": os.path.abspath(paper_dir)})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def connect_in_memory_mongo():
+    import mongomock
+    from mongoengine import connect
+    from mongomock.collection import BulkOperationBuilder
+
+    # pymongo 4.11+ passes sort to bulk updates, which mongomock does not accept yet
+    if not getattr(BulkOperationBuilder, "accepts_sort", False):
+        add_update, add_replace = BulkOperationBuilder.add_update, BulkOperationBuilder.add_replace
+        BulkOperationBuilder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+        BulkOperationBuilder.add_replace = lambda self, *args, sort=None, **kwargs: add_replace(self, *args, **kwargs)
+        BulkOperationBuilder.accepts_sort = True
+    from src.CacheDB import CacheDB
+    connection = connect(db="mdds_benchmark", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    CacheDB.ensure_schema()
+    return connection
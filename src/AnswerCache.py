@@ -0,0 +1,47 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+class AnswerCache:
+    """In-process LRU of cached answers by record id, in front of CacheDB"""
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, record_id):
+        with self.lock:
+            entry = self.entries.get(record_id)
+            if entry is not None and (entry[1] is None or entry[1] > datetime.now()):
+                self.entries.move_to_end(record_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[record_id]
+            self.misses += 1
+            return None
+
+    def put(self, record_id, answer, expires_at):
+        with self.lock:
+            self.entries[record_id] = (answer, expires_at)
+            self.entries.move_to_end(record_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, record_ids):
+        with self.lock:
+            for record_id in record_ids:
+                self.entries.pop(record_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+answer_cache = AnswerCache(int(os.getenv("CACHE_LRU_SIZE", "1024")))
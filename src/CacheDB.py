@@ -1,15 +1,62 @@
-from mongoengine import Document, StringField, DateTimeField
-from datetime import datetime
+import hashlib
+import os
+import re
+from mongoengine import Document, StringField, DateTimeField, ListField, FloatField, IntField
+from datetime import datetime, timedelta
+
+# Seconds an answer stays cached, deep answers cite recent arXiv papers so they age out sooner
+CACHE_TTL = {
+    "normal": int(os.getenv("CACHE_TTL_NORMAL", str(30 * 24 * 3600))),
+    "deep": int(os.getenv("CACHE_TTL_DEEP", str(7 * 24 * 3600)))
+}
+# Entries kept per tag, the least recently hit ones are evicted first
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+def normalize_query(query):
+    # Case, punctuation and whitespace differences still count as the same question
+    return " ".join(re.sub(r'[^\w\s]', ' ', query.lower()).split())
+
+def query_hash(query):
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+def expires_at(tag, now=None):
+    return (now or datetime.now()) + timedelta(seconds=CACHE_TTL[tag])
 
 class CacheDB(Document):
     query = StringField(required=True)
+    queryHash = StringField()
     answer = StringField(required=True)
     tag = StringField(required=True, enum=["normal", "deep"])
-    createdAt = DateTimeField(required=True, default=datetime.now)    
+    embedding = ListField(FloatField())
+    hits = IntField(default=0)
+    createdAt = DateTimeField(required=True, default=datetime.now)
+    lastHitAt = DateTimeField(default=datetime.now)
+    expiresAt = DateTimeField()
 
     meta = {
         'collection': 'cache',
         'indexes': [
-            {'fields': ['query', 'answer', 'createdAt'], 'unique': True}
+            {'fields': ['queryHash', 'tag']},
+            {'fields': ['tag', 'lastHitAt']},
+            # Mongo deletes a document once its expiresAt has passed
+            {'fields': ['expiresAt'], 'expireAfterSeconds': 0}
         ]
-    }
\ No newline at end of file
+    }
+
+    @classmethod
+    def ensure_schema(cls):
+        # The old unique index covered the full answer text and was never used for lookups
+        collection = cls._get_collection()
+        if "query_1_answer_1_createdAt_1" in collection.index_information():
+            collection.drop_index("query_1_answer_1_createdAt_1")
+        cls.ensure_indexes()
+
+    @classmethod
+    def evict(cls, tag, max_entries=CACHE_MAX_ENTRIES):
+        """Deletes the least recently hit entries above max_entries, returns their ids"""
+        excess = cls.objects(tag=tag).count() - max_entries
+        if excess <= 0:
+            return []
+        record_ids = [record.id for record in cls.objects(tag=tag).order_by('lastHitAt', 'hits').only('id').limit(excess)]
+        cls.objects(id__in=record_ids).delete()
+        return [str(record_id) for record_id in record_ids]
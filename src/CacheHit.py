@@ -1,41 +1,112 @@
-from sentence_transformers import SentenceTransformer
-from src.CacheDB import CacheDB
-from mongoengine import connect
-import os
-from dotenv import load_dotenv
-from src.util import cosine_similarity
-import concurrent.futures
+from datetime import datetime
+from typing import TYPE_CHECKING
+from src.AnswerCache import answer_cache
+from src.CacheDB import CacheDB, expires_at, query_hash
+from src.CacheIndex import cache_index
+from src.CacheWriter import cache_writer
+from src.EmbeddingService import get_embedding_service
+from src.Tracing import annotate, span, traced
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 def check_cache_deep(query, model, query_embedding):
-    for cached_query in CacheDB.objects(tag="deep"):
-        cached_embedding = model.encode(cached_query.query)
-        similarity = cosine_similarity(query_embedding, cached_embedding)
-        if similarity > 0.8:
-            return cached_query.answer
+    return fetch_answer(cache_index.search("deep", query_embedding))
 
 def check_cache_normal(query, model, query_embedding):
-    for cached_query in CacheDB.objects(tag="normal"):
-        cached_embedding = model.encode(cached_query.query)
-        similarity = cosine_similarity(query_embedding, cached_embedding)
-        if similarity > 0.8:
-            return cached_query.answer
+    return fetch_answer(cache_index.search("normal", query_embedding))
+
+def check_cache_exact(query):
+    hashed = query_hash(query)
+    for tag in ("deep", "normal"):
+        answer = fetch_answer(cache_index.lookup(tag, hashed))
+        if answer:
+            return tag, answer
+
+    # Another process may have saved it since the index loaded
+    now = datetime.now()
+    with span("CacheDB.lookup"):
+        records = {record.tag: record for record in CacheDB.objects(queryHash=hashed, tag__in=["deep", "normal"], expiresAt__gt=now)
+                   .only('id', 'tag', 'answer', 'embedding', 'expiresAt')}
+    for tag in ("deep", "normal"):
+        record = records.get(tag)
+        if record is not None:
+            record_id = str(record.id)
+            answer_cache.put(record_id, record.answer, record.expiresAt)
+            if record.embedding:
+                cache_index.add(tag, record_id, record.embedding, hashed, record.expiresAt)
+            cache_writer.record_hit(record_id)
+            return tag, record.answer
+    return None, None
+
+def fetch_answer(record_id):
+    if record_id is None:
+        return None
+
+    answer = answer_cache.get(record_id)
+    if answer is None:
+        with span("CacheDB.fetch"):
+            record = CacheDB.objects(id=record_id).only('answer', 'expiresAt').first()
+        if record is None:
+            # Expired or evicted by another process
+            cache_index.remove([record_id])
+            return None
+        answer = record.answer
+        answer_cache.put(record_id, answer, record.expiresAt)
+
+    # Hit counters feed LRU eviction, they are written behind like inserts
+    cache_writer.record_hit(record_id)
+    return answer
+
+@traced("CacheHit")
+def CacheHit(query: str, model: "SentenceTransformer"):
+    # The connection is owned by the "mongo" resource in src.main
+    cache_index.load(model)
+
+    # Repeats of a cached query need neither the model nor, once its answer is in the LRU, a database round trip
+    tag, answer = check_cache_exact(query)
+    if answer:
+        annotate(hit=True, tag=tag, exact=True)
+        return answer
 
-def CacheHit(query: str, model: SentenceTransformer):
-    load_dotenv()
-    connect(host=os.getenv("MONGO_URI"))
+    cache_index.refresh()
+    query_embedding = get_embedding_service(model).encode(query)
 
-    query_embedding = model.encode(query)
+    deep_result = check_cache_deep(query, model, query_embedding)
+    if deep_result:
+        annotate(hit=True, tag="deep", exact=False)
+        return deep_result
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        deep_future = executor.submit(check_cache_deep, query, model, query_embedding)
-        normal_future = executor.submit(check_cache_normal, query, model, query_embedding)
+    normal_result = check_cache_normal(query, model, query_embedding)
+    if normal_result:
+        annotate(hit=True, tag="normal", exact=False)
+        return normal_result
 
-        deep_result = deep_future.result()
-        if deep_result:
-            return deep_result
+    annotate(hit=False)
+    return False
 
-        normal_result = normal_future.result()
-        if normal_result:
-            return normal_result
+@traced("save_to_cache")
+def save_to_cache(query: str, answer: str, tag: str, model: "SentenceTransformer"):
+    # The answer is already computed, a failing cache write must not fail the response
+    try:
+        embedding = get_embedding_service(model).encode(query)
+        hashed = query_hash(query)
+        now = datetime.now()
+        expires = expires_at(tag, now)
 
-    return False
\ No newline at end of file
+        # The in-process tiers see the entry right away, Mongo gets it with the next bulk write
+        record_id = cache_writer.insert(CacheDB(
+            query=query,
+            queryHash=hashed,
+            answer=answer,
+            tag=tag,
+            embedding=embedding.tolist(),
+            createdAt=now,
+            lastHitAt=now,
+            expiresAt=expires
+        ))
+        answer_cache.put(record_id, answer, expires)
+        cache_index.add(tag, record_id, embedding, hashed, expires)
+    except Exception as e:
+        annotate(error=str(e))
+        print(f"Failed to cache the answer: {str(e)}")
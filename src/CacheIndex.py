@@ -0,0 +1,178 @@
+import os
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import faiss
+from src.CacheDB import CacheDB, expires_at, query_hash
+from src.EmbeddingService import get_embedding_service
+from src.Tracing import span
+
+class CacheIndex:
+    def __init__(self, dimension=768, tags=("deep", "normal"), refresh_interval=30, refresh_margin=60):
+        self.dimension = dimension
+        self.tags = tags
+        # Entries saved by other processes are picked up at most every refresh_interval seconds. The margin covers
+        # records that reached Mongo through another process's write-behind queue after their createdAt
+        self.refresh_interval = refresh_interval
+        self.refresh_margin = refresh_margin
+        self.refreshed_at = None
+        self.indexes = {}
+        # Per tag, by faiss id: record id, query hash and expiry, answers themselves stay in Mongo and src.AnswerCache
+        self.entries = {}
+        self.hashes = {}
+        self.next_expiry = {}
+        # Record id -> (tag, faiss id), so evicted records can be deleted from their index
+        self.ids = {}
+        self.next_id = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def new_index(self):
+        # Exact search over at most CACHE_MAX_ENTRIES vectors per tag, and unlike HNSW it can delete them
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+
+    def load(self, model):
+        # Build one index per tag from the stored embeddings, backfilling fields of records saved by older versions
+        with self.lock:
+            if self.loaded:
+                return
+            now = datetime.now()
+            self.refreshed_at = now
+            for tag in self.tags:
+                self.indexes[tag] = self.new_index()
+                self.entries[tag] = {}
+                self.hashes[tag] = {}
+                self.next_expiry[tag] = datetime.max
+
+                records = list(CacheDB.objects(tag=tag).only('id', 'query', 'queryHash', 'embedding', 'createdAt', 'expiresAt'))
+                missing = [record for record in records if not record.embedding]
+                if missing:
+                    embeddings = get_embedding_service(model).encode([record.query for record in missing], batch_size=64)
+                    for record, embedding in zip(missing, embeddings):
+                        record.embedding = embedding.tolist()
+                        CacheDB.objects(id=record.id).update_one(set__embedding=record.embedding)
+
+                for record in records:
+                    if not record.queryHash or record.expiresAt is None:
+                        record.queryHash = record.queryHash or query_hash(record.query)
+                        record.expiresAt = record.expiresAt or expires_at(tag, record.createdAt)
+                        CacheDB.objects(id=record.id).update_one(set__queryHash=record.queryHash, set__expiresAt=record.expiresAt)
+
+                records = [record for record in records if record.expiresAt > now]
+                if records:
+                    self.add_many(
+                        tag,
+                        [str(record.id) for record in records],
+                        [record.embedding for record in records],
+                        [record.queryHash for record in records],
+                        [record.expiresAt for record in records]
+                    )
+            self.loaded = True
+
+    def refresh(self):
+        """Adds the entries other processes saved since the last load or refresh"""
+        now = datetime.now()
+        with self.lock:
+            if not self.loaded or (now - self.refreshed_at).total_seconds() < self.refresh_interval:
+                return
+            since = self.refreshed_at - timedelta(seconds=self.refresh_margin)
+            self.refreshed_at = now
+
+        with span("CacheIndex.refresh") as refresh_span:
+            records = list(CacheDB.objects(createdAt__gte=since, expiresAt__gt=now).only('id', 'tag', 'queryHash', 'embedding', 'expiresAt'))
+            with self.lock:
+                added = 0
+                for tag in self.tags:
+                    new = [record for record in records if record.tag == tag and record.embedding and str(record.id) not in self.ids]
+                    if new and tag in self.indexes:
+                        self.add_many(
+                            tag,
+                            [str(record.id) for record in new],
+                            [record.embedding for record in new],
+                            [record.queryHash for record in new],
+                            [record.expiresAt for record in new]
+                        )
+                        added += len(new)
+            refresh_span.set(records=len(records), added=added)
+
+    def reset(self):
+        with self.lock:
+            self.indexes = {}
+            self.entries = {}
+            self.hashes = {}
+            self.next_expiry = {}
+            self.ids = {}
+            self.loaded = False
+
+    def add_many(self, tag, record_ids, embeddings, hashes, expiry):
+        vectors = np.asarray(embeddings, dtype='float32').reshape(-1, self.dimension).copy()
+        faiss.normalize_L2(vectors)
+        faiss_ids = np.arange(self.next_id, self.next_id + len(vectors), dtype=np.int64)
+        self.next_id += len(vectors)
+        self.indexes[tag].add_with_ids(vectors, faiss_ids)
+        for faiss_id, record_id, hashed, expires in zip(faiss_ids.tolist(), record_ids, hashes, expiry):
+            self.entries[tag][faiss_id] = (record_id, hashed, expires)
+            self.hashes[tag][hashed] = faiss_id
+            self.ids[record_id] = (tag, faiss_id)
+            self.next_expiry[tag] = min(self.next_expiry[tag], expires)
+
+    def add(self, tag, record_id, embedding, hashed, expires):
+        with self.lock:
+            if not self.loaded or record_id in self.ids:
+                return
+            self.add_many(tag, [record_id], [embedding], [hashed], [expires])
+
+    def delete(self, tag, faiss_ids):
+        self.indexes[tag].remove_ids(np.asarray(faiss_ids, dtype=np.int64))
+        for faiss_id in faiss_ids:
+            record_id, hashed, _ = self.entries[tag].pop(faiss_id)
+            self.ids.pop(record_id, None)
+            if self.hashes[tag].get(hashed) == faiss_id:
+                del self.hashes[tag][hashed]
+
+    def remove(self, record_ids):
+        """Deletes evicted records, so the index holds no more than the entries Mongo keeps"""
+        with self.lock:
+            by_tag = {}
+            for record_id in record_ids:
+                if record_id in self.ids:
+                    tag, faiss_id = self.ids[record_id]
+                    by_tag.setdefault(tag, []).append(faiss_id)
+            for tag, faiss_ids in by_tag.items():
+                self.delete(tag, faiss_ids)
+
+    def expire(self, tag, now):
+        # Expired entries are deleted by the first lookup after the earliest of them expires
+        if now < self.next_expiry[tag]:
+            return
+        expired = [faiss_id for faiss_id, (_, _, expires) in self.entries[tag].items() if expires <= now]
+        if expired:
+            self.delete(tag, expired)
+        self.next_expiry[tag] = min((expires for _, _, expires in self.entries[tag].values()), default=datetime.max)
+
+    def lookup(self, tag, hashed):
+        """Record id of a live entry whose normalized query hashes the same, without encoding the query"""
+        with self.lock:
+            if tag not in self.entries:
+                return None
+            self.expire(tag, datetime.now())
+            faiss_id = self.hashes[tag].get(hashed)
+            return self.entries[tag][faiss_id][0] if faiss_id is not None else None
+
+    def search(self, tag, query_embedding, threshold=0.8):
+        vector = np.asarray(query_embedding, dtype='float32').reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        with self.lock:
+            index = self.indexes.get(tag)
+            if index is None:
+                return None
+            # Only live entries are left in the index, so the nearest one is the answer or there is none
+            self.expire(tag, datetime.now())
+            if index.ntotal == 0:
+                return None
+            similarities, faiss_ids = index.search(vector, 1)
+            if faiss_ids[0][0] == -1 or similarities[0][0] <= threshold:
+                return None
+            return self.entries[tag][int(faiss_ids[0][0])][0]
+
+cache_index = CacheIndex(refresh_interval=float(os.getenv("CACHE_REFRESH_S", "30")))
@@ -0,0 +1,173 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from src.AnswerCache import answer_cache
+from src.CacheDB import CacheDB
+from src.CacheIndex import cache_index
+from src.Tracing import tracer
+
+STOP = object()
+
+class CacheWriter:
+    """Write-behind queue for cache inserts and hit counters, flushed as bulk writes by a background thread"""
+    def __init__(self, max_batch=100, flush_interval_ms=200, max_retries=3, retry_backoff_ms=100):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff_ms / 1000
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def insert(self, record):
+        """Queues a new CacheDB document, returns its id right away"""
+        if record.id is None:
+            record.id = ObjectId()
+        record.validate()
+        self.put(('insert', record.tag, record.to_mongo().to_dict()))
+        return str(record.id)
+
+    def record_hit(self, record_id):
+        self.put(('hit', record_id, datetime.now()))
+
+    def put(self, operation):
+        self.start()
+        self.queue.put(operation)
+
+    def start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="cache-writer", daemon=True)
+                self.worker.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.perf_counter() + self.flush_interval
+            while len(pending) < self.max_batch and pending[-1] is not STOP:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self.flush([operation for operation in pending if operation is not STOP])
+            except Exception as e:
+                print(f"Cache writer failed to flush {len(pending)} operations: {str(e)}")
+            finally:
+                for _ in pending:
+                    self.queue.task_done()
+            if pending[-1] is STOP:
+                return
+
+    def flush(self, operations):
+        if not operations:
+            return
+
+        # Hits on the same record collapse into one update
+        inserts, tags, hits = {}, set(), {}
+        for kind, key, value in operations:
+            if kind == 'insert':
+                inserts[str(value['_id'])] = value
+                tags.add(key)
+            else:
+                count, last_hit = hits.get(key, (0, value))
+                hits[key] = (count + 1, max(last_hit, value))
+
+        # The bulk write is unordered, so hits on a record inserted in the same batch go into its document,
+        # an update could run before the insert and match nothing
+        for record_id in [record_id for record_id in hits if record_id in inserts]:
+            count, last_hit = hits.pop(record_id)
+            document = inserts[record_id]
+            document['hits'] = document.get('hits', 0) + count
+            document['lastHitAt'] = max(document['lastHitAt'], last_hit) if document.get('lastHitAt') else last_hit
+
+        requests = [InsertOne(document) for document in inserts.values()]
+        requests.extend(
+            UpdateOne({'_id': ObjectId(record_id)}, {'$inc': {'hits': count}, '$max': {'lastHitAt': last_hit}})
+            for record_id, (count, last_hit) in hits.items()
+        )
+
+        with tracer.span("CacheWriter.flush", operations=len(operations), requests=len(requests)) as flush_span:
+            written = self.bulk_write(requests)
+            flush_span.set(written=written)
+            for tag in tags:
+                evicted = CacheDB.evict(tag)
+                if evicted:
+                    cache_index.remove(evicted)
+                    answer_cache.discard(evicted)
+
+        with self.lock:
+            self.batches += 1
+            self.written += written
+            self.dropped += len(requests) - written
+
+    def bulk_write(self, requests):
+        collection = CacheDB._get_collection()
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = collection.bulk_write(requests, ordered=False)
+                return result.inserted_count + result.matched_count
+            except BulkWriteError as e:
+                # Per document errors, e.g. a duplicate key from a retried insert, fail the same way every time
+                details = e.details
+                return details.get('nInserted', 0) + details.get('nMatched', 0)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    print(f"Dropped {len(requests)} cache writes after {attempt + 1} attempts: {str(e)}")
+                    return 0
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self.retry_backoff * 2 ** attempt)
+
+    def drain(self, timeout=None):
+        """Blocks until every queued operation is written, returns False on timeout"""
+        end = None if timeout is None else time.perf_counter() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if end is None else end - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        # Registered with atexit so queued writes are flushed before the process exits
+        with self.lock:
+            worker, self.worker = self.worker, None
+        if worker is None:
+            return
+        self.queue.put(STOP)
+        worker.join(timeout)
+        if worker.is_alive():
+            print(f"Cache writer still had {self.queue.qsize()} operations queued at exit")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'written': self.written,
+                'retries': self.retries,
+                'dropped': self.dropped,
+                'queued': self.queue.qsize()
+            }
+
+cache_writer = CacheWriter(
+    max_batch=int(os.getenv("CACHE_WRITE_BATCH", "100")),
+    flush_interval_ms=float(os.getenv("CACHE_WRITE_INTERVAL_MS", "200")),
+    max_retries=int(os.getenv("CACHE_WRITE_RETRIES", "3"))
+)
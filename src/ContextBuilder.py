@@ -0,0 +1,146 @@
+import os
+import re
+import threading
+import numpy as np
+from src.EmbeddingService import get_embedding_service
+from src.Tracing import span
+
+# tiktoken reads its BPE files from here instead of downloading them
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", "temp/data-gym-cache")
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+WORD_PATTERN = re.compile(r'\w+')
+
+encoding = None
+encoding_lock = threading.Lock()
+
+def get_encoding(model_name="gpt-4o-mini"):
+    global encoding
+    with encoding_lock:
+        if encoding is None:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+    return encoding
+
+def count_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def compact_metadata(metadata):
+    # Enough to cite a source, the abstract is left out
+    fields = []
+    if metadata.get('title'):
+        fields.append(f"title: {metadata['title']}")
+    authors = metadata.get('authors')
+    if isinstance(authors, list) and authors:
+        fields.append(f"authors: {', '.join(authors[:3])}{' et al.' if len(authors) > 3 else ''}")
+    elif authors:
+        fields.append(f"authors: {authors}")
+    if metadata.get('published'):
+        fields.append(f"published: {metadata['published']}")
+    return ", ".join(fields)
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+def query_overlap(sentence, query_words):
+    return len(query_words.intersection(WORD_PATTERN.findall(sentence.lower())))
+
+def truncate_tokens(text, max_tokens):
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def build_context(chunks, query, model, budget=3000, max_sentences=16, candidate_factor=2, min_truncated_tokens=32):
+    """Numbered chunks with compact metadata, keeping the sentences most similar to the query within the token budget"""
+    headers = [f"[{i}] Metadata: {compact_metadata(chunk['metadata'])}\nContent: " for i, chunk in enumerate(chunks, 1)]
+    with span("ContextBuilder.build", chunks=len(chunks), budget=budget) as build_span:
+        header_tokens = [count_tokens(header) for header in headers]
+        text_tokens = [count_tokens(chunk['chunk_text']) for chunk in chunks]
+        full_tokens = sum(header_tokens) + sum(text_tokens)
+        build_span.set(full_tokens=full_tokens)
+        if full_tokens <= budget:
+            build_span.set(tokens=full_tokens, compressed=False)
+            return "".join(f"{header}{chunk['chunk_text']}\n\n" for header, chunk in zip(headers, chunks))
+
+        # Most relevant chunks first. Only the ones that can plausibly fill the budget get their sentences encoded,
+        # and long chunks only send the sentences sharing the most words with the query
+        if all('score' in chunk for chunk in chunks):
+            order = sorted(range(len(chunks)), key=lambda i: -chunks[i]['score'])
+        else:
+            order = list(range(len(chunks)))
+        query_words = {word for word in WORD_PATTERN.findall(query.lower()) if len(word) > 3}
+        sentences, positions, sentence_costs = {}, {}, {}
+        candidate_tokens = 0
+        for i in order:
+            if candidate_tokens >= candidate_factor * budget:
+                break
+            chunk_sentences = split_sentences(chunks[i]['chunk_text'])
+            keep = list(range(len(chunk_sentences)))
+            if len(keep) > max_sentences:
+                keep = sorted(sorted(keep, key=lambda j: -query_overlap(chunk_sentences[j], query_words))[:max_sentences])
+            if keep:
+                sentences[i] = [chunk_sentences[j] for j in keep]
+                positions[i] = keep
+                sentence_costs[i] = [count_tokens(sentence) + 1 for sentence in sentences[i]]
+                candidate_tokens += header_tokens[i] + sum(sentence_costs[i])
+
+        order = [i for i in order if i in sentences]
+        flat = [sentence for i in order for sentence in sentences[i]]
+        if not flat:
+            build_span.set(tokens=0, compressed=True)
+            return ""
+
+        embeddings = get_embedding_service(model)
+        vectors = np.asarray(embeddings.encode(flat, batch_size=64), dtype='float32').reshape(len(flat), -1)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query_vector = np.asarray(embeddings.encode(query), dtype='float32').reshape(-1)
+        scores = vectors @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+        costs = [cost for i in order for cost in sentence_costs[i]]
+        starts, owners = {}, []
+        for i in order:
+            starts[i] = len(owners)
+            owners.extend([i] * len(sentences[i]))
+
+        # Each chunk keeps its best sentence while the budget allows, a best sentence longer than what is left
+        # is cut to fit. The rest of the budget goes to the best remaining sentences across all kept chunks
+        remaining = budget
+        kept_chunks, selected, truncated = set(), set(), {}
+        for i in order:
+            start = starts[i]
+            best = start + int(np.argmax(scores[start:start + len(sentences[i])]))
+            room = remaining - header_tokens[i]
+            if costs[best] <= room:
+                kept_chunks.add(i)
+                selected.add(best)
+                remaining -= header_tokens[i] + costs[best]
+            elif room - 1 >= min_truncated_tokens:
+                kept_chunks.add(i)
+                selected.add(best)
+                truncated[best] = truncate_tokens(flat[best], room - 1)
+                remaining -= header_tokens[i] + count_tokens(truncated[best]) + 1
+
+        for k in np.argsort(-scores):
+            k = int(k)
+            if owners[k] in kept_chunks and k not in selected and costs[k] <= remaining:
+                selected.add(k)
+                remaining -= costs[k]
+
+        # Chunks keep their numbering and order, gaps between kept sentences are marked so the model
+        # does not read them as continuous text
+        context = ""
+        for i in sorted(kept_chunks):
+            parts, previous = [], None
+            for j in range(len(sentences[i])):
+                k = starts[i] + j
+                if k in selected:
+                    if previous is not None and positions[i][j] != previous + 1:
+                        parts.append("...")
+                    parts.append(truncated.get(k, flat[k]))
+                    previous = positions[i][j]
+            context += f"{headers[i]}{' '.join(parts)}\n\n"
+
+        build_span.set(tokens=budget - remaining, compressed=True, sentences=len(selected), encoded_sentences=len(flat),
+                       chunks_kept=len(kept_chunks), truncated=len(truncated))
+        return context
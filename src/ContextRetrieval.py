@@ -1,13 +1,25 @@
 import faiss
-import spacy
+import threading
 import networkx as nx
+from collections import Counter
 from itertools import combinations
-import concurrent.futures
+from src.EmbeddingService import get_embedding_service
+from src.IndexBuilder import search_parameters
+from src.Tracing import span
 
-nlp = spacy.load("en_core_web_sm")
+nlp = None
+nlp_lock = threading.Lock()
+
+def get_nlp():
+    global nlp
+    with nlp_lock:
+        if nlp is None:
+            import spacy
+            nlp = spacy.load("en_core_web_sm")
+    return nlp
 
 class ContextRetrieval:
-    def __init__(self, model, knowledge_graph, vector_db, dictionary, subquery, k=15, graph_search_method='one_hop'):
+    def __init__(self, model, knowledge_graph, vector_db, dictionary, subquery=None, k=15, graph_search_method='one_hop', entity_index=None, search_params=None):
         self.model = model
         self.knowledge_graph = knowledge_graph
         self.vector_db = vector_db
@@ -15,24 +27,53 @@ class ContextRetrieval:
         self.subquery = subquery
         self.k = k
         self.graph_search_method = graph_search_method
+        self.entity_index = entity_index
+        self.search_params = search_params or {}
 
     def retrieve(self):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            wide_net_future = executor.submit(self.retrieve_from_vector_db, self.model, self.subquery, self.vector_db)
-            tags_future = executor.submit(self.retrieve_from_knowledge_graph, self.subquery, self.knowledge_graph)
+        return self.retrieve_batch([self.subquery])[0]
+
+    def retrieve_batch(self, subqueries):
+        # One encode batch and one matrix search for every subquery, results are returned per subquery
+        with span("ContextRetrieval.retrieve", subqueries=len(subqueries), k=self.k) as retrieve_span:
+            with span("ContextRetrieval.vector_search", k=self.k, index=type(self.vector_db).__name__) as vector_span:
+                wide_nets = self.retrieve_from_vector_db_batch(self.model, subqueries, self.vector_db)
+                vector_span.set(chunks=sum(len(wide_net) for wide_net in wide_nets))
+
+            with span("ContextRetrieval.knowledge_graph", method=self.graph_search_method) as graph_span:
+                tag_groups = []
+                start_tag_count = 0
+                for doc in get_nlp().pipe(subqueries):
+                    start_tags = self.extract_start_tags(doc)
+                    start_tag_count += len(start_tags)
+                    tag_groups.append(self.expand_tags(start_tags, self.knowledge_graph))
+                graph_span.set(start_tags=start_tag_count, expanded_tags=sum(len(group) for tags in tag_groups for group in tags))
+
+            results = [self.match_chunks(wide_net, tags) for wide_net, tags in zip(wide_nets, tag_groups)]
+            retrieve_span.set(matched_chunks=sum(len(context) for context, disclaimer in results if not disclaimer), fallbacks=sum(1 for context, disclaimer in results if disclaimer))
+            return results
+
+    def match_chunks(self, wide_net, tags):
+        # Graph expansion returns one group of neighbor names per start entity
+        flat_tags = [tag for group in tags for tag in group]
+
+        if self.entity_index is not None:
+            match_counts = self.entity_index.match_counts([chunk['chunk_id'] for chunk in wide_net], flat_tags)
+        else:
+            tag_counts = Counter(flat_tags)
+            match_counts = [sum(tag_counts[entity] for entity in chunk['entities']) for chunk in wide_net]
 
-            wide_net = wide_net_future.result()
-            tags = tags_future.result()
-        
         matched_chunks = {}
         for i, chunk in enumerate(wide_net):
-            entities = chunk['entities']
-            match_count = sum(entities.count(tag) for tag in tags)
+            match_count = int(match_counts[i])
             if match_count > 0:
                 matched_chunks[i] = {
+                    'chunk_id': chunk['chunk_id'],
                     'chunk_text': chunk['text'],
                     'metadata': chunk['metadata'],
-                    'match_count': match_count
+                    'match_count': match_count,
+                    'score': chunk['score'],
+                    'rank': chunk['rank']
                 }
 
         if matched_chunks == {}:
@@ -49,19 +90,36 @@ class ContextRetrieval:
         return list(matched_chunks.values()), ""
             
     def retrieve_from_vector_db(self, model, query, vector_db):
-        # Use vector_db to retrieve relevant context based on the query
-        embedding = model.encode(query).reshape(1, -1).astype('float32')
-        faiss.normalize_L2(embedding)
-        distances, indices = vector_db.search(embedding, self.k)
+        return self.retrieve_from_vector_db_batch(model, [query], vector_db)[0]
+
+    def retrieve_from_vector_db_batch(self, model, queries, vector_db):
+        # Use vector_db to retrieve relevant context for all queries in a single search
+        embeddings = get_embedding_service(model).encode(list(queries)).reshape(len(queries), -1).copy()
+        faiss.normalize_L2(embeddings)
+        params = search_parameters(vector_db, **self.search_params)
+        distances, indices = vector_db.search(embeddings, self.k, params=params)
+        scores = self.distances_to_scores(distances, vector_db)
+
         results = []
-        for i in indices[0]:
-            results.append(self.dictionary[i])
-        
+        for row, row_scores in zip(indices, scores):
+            results.append([
+                dict(self.dictionary[i], chunk_id=int(i), score=float(score), rank=rank)
+                # Chunks promoted while this request was running are not in its dictionary yet
+                for rank, (i, score) in enumerate(zip(row, row_scores)) if 0 <= i < len(self.dictionary)
+            ])
         return results
+
+    def distances_to_scores(self, distances, vector_db):
+        # Vectors are unit length, so squared L2 distance d maps to cosine similarity 1 - d / 2
+        if vector_db.metric_type == faiss.METRIC_INNER_PRODUCT:
+            return distances
+        return 1 - distances / 2
     
     def retrieve_from_knowledge_graph(self, query, knowledge_graph):
         # .gitignore the graph file since its too big
-        doc = nlp(query)
+        return self.expand_tags(self.extract_start_tags(get_nlp()(query)), knowledge_graph)
+
+    def extract_start_tags(self, doc):
         start_tags = []
         for sent in doc.sents:
             subj, obj = None, None
@@ -72,7 +130,9 @@ class ContextRetrieval:
                 if "obj" in tok.dep_:
                     obj = tok
                     start_tags.append(obj.text)
-        
+        return start_tags
+
+    def expand_tags(self, start_tags, knowledge_graph):
         if not start_tags:
             return []
         
@@ -88,5 +148,8 @@ class ContextRetrieval:
             shared = []
             for entity1, entity2 in combinations(start_tags, 2):
                 if knowledge_graph.has_node(entity1) and knowledge_graph.has_node(entity2):
-                    shared.append(nx.common_neighbors(knowledge_graph, entity1, entity2))
-            return shared
\ No newline at end of file
+                    if hasattr(knowledge_graph, 'common_neighbors'):
+                        shared.append(knowledge_graph.common_neighbors(entity1, entity2))
+                    else:
+                        shared.append(nx.common_neighbors(knowledge_graph, entity1, entity2))
+            return shared
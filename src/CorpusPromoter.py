@@ -0,0 +1,160 @@
+import os
+import re
+import threading
+import faiss
+import numpy as np
+from src.CorpusStore import CorpusStore, append_chunks
+from src.EntityIndex import EntityIndex
+from src.Ingest import tag_chunk, write_index
+from src.Resources import resources
+from src.Tracing import annotate, traced
+
+VERSION_SUFFIX = re.compile(r'v\d+$')
+
+def base_arxiv_id(arxiv_id):
+    # 1509.08591v1 and 1509.08591v2 are the same paper
+    return VERSION_SUFFIX.sub("", arxiv_id)
+
+class PromotedIndex:
+    """The shipped index plus an ID-mapped index of promoted chunks, searched as one index"""
+    def __init__(self, base_index, promoted):
+        self.base_index = base_index
+        self.promoted = promoted
+        self.lock = threading.Lock()
+
+    @property
+    def d(self):
+        return self.base_index.d
+
+    @property
+    def metric_type(self):
+        return self.base_index.metric_type
+
+    @property
+    def ntotal(self):
+        return self.base_index.ntotal + self.promoted.ntotal
+
+    def search(self, x, k, params=None):
+        # Search parameters only apply to the base index, the promoted chunks are searched exactly
+        distances, indices = self.base_index.search(x, k, params=params)
+        with self.lock:
+            if self.promoted.ntotal == 0:
+                return distances, indices
+            promoted_distances, promoted_indices = self.promoted.search(x, k)
+
+        distances = np.hstack([distances, promoted_distances])
+        indices = np.hstack([indices, promoted_indices])
+        order_by = -distances if self.metric_type == faiss.METRIC_INNER_PRODUCT else distances
+        order = np.argsort(np.where(indices < 0, np.inf, order_by), axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def reconstruct(self, key):
+        if key < self.base_index.ntotal:
+            return self.base_index.reconstruct(key)
+        with self.lock:
+            return self.promoted.reconstruct(key)
+
+    def add(self, ids, vectors):
+        with self.lock:
+            self.promoted.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def save(self, path):
+        with self.lock:
+            write_index(self.promoted, path)
+
+def load_promoted_index(base_index, path):
+    if os.path.exists(path):
+        promoted = faiss.read_index(path)
+    else:
+        promoted = faiss.IndexIDMap2(faiss.IndexFlat(base_index.d, base_index.metric_type))
+    return PromotedIndex(base_index, promoted)
+
+class CorpusPromoter:
+    """Appends deep-search papers to the corpus store and the promoted index, once per arXiv id"""
+    def __init__(self, corpus_dir, index_path):
+        self.corpus_dir = corpus_dir
+        self.index_path = index_path
+        self.arxiv_ids = None
+        self.reported = set()
+        self.lock = threading.Lock()
+
+    def report_skip(self, reason):
+        # Printed once per reason, every deep search would otherwise repeat it
+        annotate(skipped=reason)
+        if reason not in self.reported:
+            self.reported.add(reason)
+            print(f"Deep search papers are not promoted, {reason}")
+
+    def check_corpus(self):
+        """Reports at startup when the corpus is still the JSON list, which promotion cannot append to"""
+        if os.path.exists(os.path.join(self.corpus_dir, "text_offsets.npy")):
+            return True
+        self.report_skip(f"{self.corpus_dir} has no corpus store, create it with `python -m src.CorpusStore`")
+        return False
+
+    def skip_reason(self, dictionary, vector_db):
+        if not isinstance(dictionary, CorpusStore):
+            return f"{self.corpus_dir} has no corpus store, create it with `python -m src.CorpusStore`"
+        if not isinstance(vector_db, PromotedIndex):
+            return "the vector DB is not wrapped in the promoted index"
+        if len(dictionary) != vector_db.ntotal:
+            return f"the index holds {vector_db.ntotal} vectors but the corpus holds {len(dictionary)} chunks, rebuild one of them"
+        return None
+
+    def known_arxiv_ids(self, dictionary):
+        # Papers added by src.Ingest carry their arXiv id in the metadata too
+        if self.arxiv_ids is None:
+            self.arxiv_ids = {base_arxiv_id(metadata['arxiv_id']) for metadata in dictionary.metadata if metadata.get('arxiv_id')}
+        return self.arxiv_ids
+
+    @traced("CorpusPromoter.promote")
+    def promote(self, papers):
+        """papers is a list of (arxiv_id, chunks) with the embedded chunks DeepSearch built for every paper"""
+        with self.lock:
+            dictionary = resources.get("dictionary")
+            vector_db = resources.get("vector_db")
+            reason = self.skip_reason(dictionary, vector_db)
+            if reason is not None:
+                self.report_skip(reason)
+                return 0
+
+            # Only the first version of a paper is promoted, newer versions reach the corpus with the next index rebuild
+            known = self.known_arxiv_ids(dictionary)
+            new_papers = {}
+            for arxiv_id, chunks in papers:
+                if arxiv_id and base_arxiv_id(arxiv_id) not in known and chunks and all(chunk['embedding'] is not None for chunk in chunks):
+                    new_papers.setdefault(base_arxiv_id(arxiv_id), (arxiv_id, chunks))
+            annotate(papers=len(papers), promoted=len(new_papers))
+            if not new_papers:
+                return 0
+
+            chunks = [(arxiv_id, chunk) for arxiv_id, paper_chunks in new_papers.values() for chunk in paper_chunks]
+            docs = resources.get("nlp").pipe(chunk['chunk_text'] for _, chunk in chunks)
+            rows = [
+                {
+                    'text': chunk['chunk_text'],
+                    'metadata': dict(chunk['metadata'], arxiv_id=arxiv_id),
+                    'entities': tag_chunk(doc)[0]
+                }
+                for (arxiv_id, chunk), doc in zip(chunks, docs)
+            ]
+            vectors = np.vstack([chunk['embedding'] for _, chunk in chunks]).astype('float32')
+            faiss.normalize_L2(vectors)
+
+            # Rows are written before their vectors so a search never returns an id the corpus does not have yet
+            first_chunk_id = append_chunks(rows, self.corpus_dir)
+            dictionary = CorpusStore.load(self.corpus_dir)
+            resources.override("entity_index", EntityIndex.build(dictionary))
+            resources.override("dictionary", dictionary)
+
+            vector_db.add(np.arange(first_chunk_id, first_chunk_id + len(rows)), vectors)
+            vector_db.save(self.index_path)
+            known.update(new_papers)
+            annotate(chunks=len(rows), first_chunk=first_chunk_id)
+            print(f"Promoted {len(new_papers)} papers ({len(rows)} chunks) into the corpus")
+            return len(rows)
+
+corpus_promoter = CorpusPromoter(
+    os.getenv("CORPUS_DIR", "data/corpus"),
+    os.getenv("PROMOTED_INDEX", "data/promoted.index")
+)
@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import numpy as np
+from src.util import write_file
+
+class CorpusStore:
+    def __init__(self, texts, text_offsets, metadata, metadata_ids, entity_names, entity_offsets, entity_ids):
+        self.texts = texts
+        self.text_offsets = text_offsets
+        self.metadata = metadata
+        self.metadata_ids = metadata_ids
+        self.entity_names = entity_names
+        self.entity_offsets = entity_offsets
+        self.entity_ids = entity_ids
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        # Only the interned metadata and entity tables are parsed, chunk columns stay on disk until a row is read
+        mmap_mode = 'r' if mmap else None
+        texts = np.memmap(os.path.join(directory, "texts.bin"), dtype=np.uint8, mode='r') if mmap else np.fromfile(os.path.join(directory, "texts.bin"), dtype=np.uint8)
+        with open(os.path.join(directory, "metadata.json"), "r") as f:
+            metadata = json.load(f)
+        with open(os.path.join(directory, "entities.json"), "r") as f:
+            entity_names = json.load(f)
+        return cls(
+            texts,
+            np.load(os.path.join(directory, "text_offsets.npy"), mmap_mode=mmap_mode),
+            metadata,
+            np.load(os.path.join(directory, "metadata_ids.npy"), mmap_mode=mmap_mode),
+            entity_names,
+            np.load(os.path.join(directory, "entity_offsets.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, "entity_ids.npy"), mmap_mode=mmap_mode)
+        )
+
+    def __len__(self):
+        return len(self.metadata_ids)
+
+    def __getitem__(self, chunk_id):
+        return {
+            'text': self.get_text(chunk_id),
+            'metadata': self.metadata[self.metadata_ids[chunk_id]],
+            'entities': self.get_entities(chunk_id)
+        }
+
+    def get_text(self, chunk_id):
+        return self.texts[self.text_offsets[chunk_id]:self.text_offsets[chunk_id + 1]].tobytes().decode("utf-8")
+
+    def get_entity_ids(self, chunk_id):
+        return self.entity_ids[self.entity_offsets[chunk_id]:self.entity_offsets[chunk_id + 1]]
+
+    def get_entities(self, chunk_id):
+        return [self.entity_names[i] for i in self.get_entity_ids(chunk_id)]
+
+def convert_chunks(chunks, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "texts.bin"), "wb") as texts:
+        columns = write_chunks(chunks, texts, [], [], 0)
+
+    save_columns(out_dir, *columns)
+    return len(columns[2])
+
+def append_chunks(chunks, out_dir):
+    """Adds chunks after the existing rows, returns the id of the first appended chunk"""
+    if not os.path.exists(os.path.join(out_dir, "text_offsets.npy")):
+        convert_chunks(chunks, out_dir)
+        return 0
+
+    store = CorpusStore.load(out_dir, mmap=False)
+    first_chunk_id = len(store)
+    text_end = int(store.text_offsets[-1])
+    with open(os.path.join(out_dir, "texts.bin"), "r+b") as texts:
+        # Bytes past the last offset are left over from an interrupted append
+        texts.truncate(text_end)
+        texts.seek(text_end)
+        metadata, entity_names, metadata_ids, entity_ids, text_offsets, entity_offsets = write_chunks(
+            chunks, texts, list(store.metadata), list(store.entity_names), text_end, len(store.entity_ids)
+        )
+
+    save_columns(
+        out_dir,
+        metadata,
+        entity_names,
+        np.concatenate([store.metadata_ids, np.asarray(metadata_ids, dtype=np.int32)]),
+        np.concatenate([store.entity_ids, np.asarray(entity_ids, dtype=np.int32)]),
+        np.concatenate([store.text_offsets, np.asarray(text_offsets[1:], dtype=np.int64)]),
+        np.concatenate([store.entity_offsets, np.asarray(entity_offsets[1:], dtype=np.int64)])
+    )
+    return first_chunk_id
+
+def write_chunks(chunks, texts, metadata, entity_names, text_end, entity_end=0):
+    metadata_index = {json.dumps(value, sort_keys=True): i for i, value in enumerate(metadata)}
+    entity_index = {entity: i for i, entity in enumerate(entity_names)}
+    metadata_ids, entity_ids = [], []
+    text_offsets, entity_offsets = [text_end], [entity_end]
+
+    for chunk in chunks:
+        encoded_text = chunk['text'].encode("utf-8")
+        texts.write(encoded_text)
+        text_offsets.append(text_offsets[-1] + len(encoded_text))
+
+        metadata_key = json.dumps(chunk['metadata'], sort_keys=True)
+        if metadata_key not in metadata_index:
+            metadata_index[metadata_key] = len(metadata)
+            metadata.append(chunk['metadata'])
+        metadata_ids.append(metadata_index[metadata_key])
+
+        for entity in chunk.get('entities', []):
+            if entity not in entity_index:
+                entity_index[entity] = len(entity_names)
+                entity_names.append(entity)
+            entity_ids.append(entity_index[entity])
+        entity_offsets.append(entity_end + len(entity_ids))
+
+    return metadata, entity_names, metadata_ids, entity_ids, text_offsets, entity_offsets
+
+def save_columns(out_dir, metadata, entity_names, metadata_ids, entity_ids, text_offsets, entity_offsets):
+    # Each file is replaced atomically so a reader never sees a half written column
+    write_file(os.path.join(out_dir, "metadata.json"), lambda f: f.write(json.dumps(metadata).encode("utf-8")))
+    write_file(os.path.join(out_dir, "entities.json"), lambda f: f.write(json.dumps(entity_names).encode("utf-8")))
+    write_file(os.path.join(out_dir, "text_offsets.npy"), lambda f: np.save(f, np.asarray(text_offsets, dtype=np.int64)))
+    write_file(os.path.join(out_dir, "metadata_ids.npy"), lambda f: np.save(f, np.asarray(metadata_ids, dtype=np.int32)))
+    write_file(os.path.join(out_dir, "entity_offsets.npy"), lambda f: np.save(f, np.asarray(entity_offsets, dtype=np.int64)))
+    write_file(os.path.join(out_dir, "entity_ids.npy"), lambda f: np.save(f, np.asarray(entity_ids, dtype=np.int32)))
+
+def convert_json(json_path, out_dir):
+    with open(json_path, "r") as f:
+        return convert_chunks(json.load(f), out_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the chunk/entity JSON into the memory-mapped columnar corpus format")
+    parser.add_argument("json_path")
+    parser.add_argument("out_dir")
+    args = parser.parse_args()
+
+    chunk_count = convert_json(args.json_path, args.out_dir)
+    print(f"Wrote {chunk_count} chunks to {args.out_dir}")
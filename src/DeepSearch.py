@@ -8,27 +8,74 @@ import xml.etree.ElementTree as ET
 import io
 from PyPDF2 import PdfReader
 import requests
-import faiss
+import numpy as np
 import concurrent.futures
+import os
+import threading
+from src.EmbeddingService import get_embedding_service
+from src.Scheduler import scheduler
+from src.Tracing import annotate, span, traced
 
-nltk.download('stopwords')
-nltk.download('wordnet')
-nltk.download('punkt')
-nltk.download('punkt_tab')
+nltk_packages = {
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+    'punkt': 'tokenizers/punkt',
+    'punkt_tab': 'tokenizers/punkt_tab'
+}
+nltk_lock = threading.Lock()
+sw_nltk = None
+lemmatizer = None
 
-sw_nltk = stopwords.words('english')
-lemmatizer = WordNetLemmatizer()
+def load_nltk():
+    # Only download corpora that are not installed yet, and only on first use
+    global sw_nltk, lemmatizer
+    with nltk_lock:
+        if sw_nltk is None:
+            for package, path in nltk_packages.items():
+                try:
+                    nltk.data.find(path)
+                except LookupError:
+                    nltk.download(package, quiet=True)
+            lemmatizer = WordNetLemmatizer()
+            sw_nltk = stopwords.words('english')
+
+def extract_pdf_text(pdf_reader):
+    pdf_text = ""
+
+    for page in pdf_reader.pages:
+        page_text = page.extract_text()
+        if page_text and page_text.strip():
+            pdf_text += page_text + " "
+
+    pdf_text = re.sub(r' {2,}', ' ', pdf_text)
+    pdf_text = re.sub(r'\n{3,}', '\n\n', pdf_text)
+    pdf_text = re.sub(r'[\f\v\r]', ' ', pdf_text)
+    pdf_text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', pdf_text)
+    pdf_text = re.sub(r'([.!?])\s*([A-Z])', r'\1 \2', pdf_text)
+    return pdf_text.strip()
+
+def chunk_sentences(sentences, chunk_size_sentences):
+    for j in range(0, len(sentences), chunk_size_sentences):
+        chunk = sentences[j:j + chunk_size_sentences]
+        chunk_text = " ".join(chunk)
+        if chunk_text:
+            yield chunk_text, len(chunk)
+
+ARXIV_API_URL = os.getenv("ARXIV_API_URL", "http://export.arxiv.org/api/query")
 
 class DeepSearch:
-    def __init__(self, query, model, k_articles=5, k_chunks=7):
+    def __init__(self, query, model, k_articles=5, k_chunks=7, paper_cache=None):
         self.query = query
         self.model = model
         self.keyword = self.extract_keyword()
         self.k_articles = k_articles
         self.k_chunks = k_chunks
-        self.index = faiss.IndexFlatL2(768)
+        self.paper_cache = paper_cache
+        # (arxiv_id, chunks) for every paper get_context embedded, used to promote them into the corpus
+        self.papers = []
 
     def extract_keyword(self):
+        load_nltk()
         question = self.query.lower()
         words = nltk.word_tokenize(question)
         words_no_punct = [re.sub(r'[^\w\s]', '', word) for word in words]
@@ -38,11 +85,18 @@ class DeepSearch:
         keyword = ' '.join(lemmatized_words)
         return keyword
 
-    def get_context(self):
+    @traced("DeepSearch.search_articles")
+    def search_articles(self):
+        if self.paper_cache is not None:
+            cached_articles = self.paper_cache.load_query(self.keyword, self.k_articles)
+            if cached_articles is not None:
+                annotate(cached=True, articles=len(cached_articles))
+                return cached_articles
+
         encodingmethod = "utf-8"
         errortype = "strict"
         encoded_search_term = urllib.parse.quote(self.keyword, encoding=encodingmethod, errors=errortype)
-        url = f'http://export.arxiv.org/api/query?search_query=all:{encoded_search_term}&start=0&max_results={self.k_articles}'
+        url = f'{ARXIV_API_URL}?search_query=all:{encoded_search_term}&start=0&max_results={self.k_articles}'
 
         try:
             response = urllib.request.urlopen(url)
@@ -65,6 +119,9 @@ class DeepSearch:
             if link is not None and "href" in link.attrib:
                 pdf_url = link.attrib['href']
 
+                entry_id = entry.find('ns:id', ns)
+                arxiv_id = entry_id.text.strip().rsplit('/abs/', 1)[-1] if entry_id is not None and entry_id.text else None
+
                 title = entry.find('ns:title', ns)
                 title_text = title.text.strip() if title is not None else "Unknown Title"
 
@@ -85,54 +142,77 @@ class DeepSearch:
                 }
 
                 articles_data.append({
+                    'arxiv_id': arxiv_id,
                     'pdf_url': pdf_url,
                     'metadata': metadata
                 })
 
-        chunks = []
+        annotate(cached=False, articles=len(articles_data))
+        if self.paper_cache is not None:
+            self.paper_cache.save_query(self.keyword, self.k_articles, articles_data)
+        return articles_data
+
+    @traced("DeepSearch.get_context")
+    def get_context(self):
+        articles_data = self.search_articles()
+
         chunk_size_sentences = 50
 
-        def process_article(article):
-            """Process a single article in parallel"""
+        def load_cached(article):
+            if self.paper_cache is None:
+                return None
+            cached_paper = self.paper_cache.load_paper(article.get('arxiv_id'))
+            if cached_paper is None:
+                return None
+            embeddings = cached_paper['embeddings']
+            return [
+                {
+                    'chunk_text': chunk['chunk_text'],
+                    'embedding': embeddings[i] if embeddings is not None else None,
+                    'metadata': article['metadata'],
+                    'sentence_count': chunk['sentence_count']
+                }
+                for i, chunk in enumerate(cached_paper['chunks'])
+            ]
+
+        def download(article):
+            """Runs on the I/O pool"""
             try:
-                pdf_response = requests.get(article['pdf_url'], timeout=30)
-                pdf_response.raise_for_status()
-
-                pdf_file = io.BytesIO(pdf_response.content)
-                pdf_reader = PdfReader(pdf_file)
-                pdf_text = ""
-
-                for page in pdf_reader.pages:
-                    page_text = page.extract_text()
-                    if page_text and page_text.strip():
-                        pdf_text += page_text + " "
-
-                pdf_text = re.sub(r' {2,}', ' ', pdf_text)
-                pdf_text = re.sub(r'\n{3,}', '\n\n', pdf_text)
-                pdf_text = re.sub(r'[\f\v\r]', ' ', pdf_text)
-                pdf_text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', pdf_text)
-                pdf_text = re.sub(r'([.!?])\s*([A-Z])', r'\1 \2', pdf_text)
-                pdf_text = pdf_text.strip()
-
-                sentences = nltk.sent_tokenize(pdf_text)
-                num_sentences = len(sentences)
-                
-                article_chunks = []
-                for j in range(0, num_sentences, chunk_size_sentences):
-                    chunk_sentences = sentences[j:j + chunk_size_sentences]
-                    chunk_text = " ".join(chunk_sentences)
+                with span("DeepSearch.download", arxiv_id=article.get('arxiv_id')) as download_span:
+                    pdf_response = requests.get(article['pdf_url'], timeout=30)
+                    pdf_response.raise_for_status()
+                    download_span.set(bytes=len(pdf_response.content))
+                return pdf_response.content
+            except Exception as e:
+                print(f"Error downloading article {article['metadata'].get('title', 'Unknown')}: {str(e)}")
+                return None
 
-                    if chunk_text:
-                        chunk_embedding = self.model.encode(chunk_text, convert_to_tensor=True)
-                        chunk_embedding = chunk_embedding.cpu().numpy().astype('float32')
+        def parse(article, content):
+            """Runs on the CPU pool, embeddings are computed later in one batch"""
+            arxiv_id = article.get('arxiv_id')
+            try:
+                with span("DeepSearch.parse", arxiv_id=arxiv_id) as parse_span:
+                    pdf_reader = PdfReader(io.BytesIO(content))
+                    pdf_text = extract_pdf_text(pdf_reader)
 
-                        chunk_data = {
+                    sentences = nltk.sent_tokenize(pdf_text)
+                    num_sentences = len(sentences)
+                
+                    article_chunks = [
+                        {
                             'chunk_text': chunk_text,
-                            'embedding': chunk_embedding,
+                            'embedding': None,
                             'metadata': article['metadata'],
-                            'sentence_count': len(chunk_sentences)
+                            'sentence_count': sentence_count
                         }
-                        article_chunks.append(chunk_data)
+                        for chunk_text, sentence_count in chunk_sentences(sentences, chunk_size_sentences)
+                    ]
+                    parse_span.set(pages=len(pdf_reader.pages), sentences=num_sentences, chunks=len(article_chunks))
+
+                if self.paper_cache is not None:
+                    self.paper_cache.save_paper(arxiv_id, pdf_text, [
+                        {'chunk_text': chunk['chunk_text'], 'sentence_count': chunk['sentence_count']} for chunk in article_chunks
+                    ])
                 
                 return article_chunks
 
@@ -140,23 +220,48 @@ class DeepSearch:
                 print(f"Error processing article {article['metadata'].get('title', 'Unknown')}: {str(e)}")
                 return []
 
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            futures = {executor.submit(process_article, article): article for article in articles_data}
-            
-            for future in concurrent.futures.as_completed(futures):
-                article_chunks = future.result()
-                for chunk_data in article_chunks:
-                    embedding = chunk_data['embedding'].reshape(1, -1).astype("float32")
-                    faiss.normalize_L2(embedding)
-                    self.index.add(embedding)
-                    chunks.append(chunk_data)
-        
-        query_embedding = self.model.encode(self.query, convert_to_tensor=True)
-        query_embedding = query_embedding.cpu().numpy().astype('float32')
-        query_embedding = query_embedding.reshape(1, -1)
-        faiss.normalize_L2(query_embedding)
-        distances, indices = self.index.search(query_embedding, k=self.k_chunks)
-
-        chunks = [chunks[i] for i in indices[0]]
-        return chunks
+        # Downloads go to the I/O pool and each PDF is handed to the CPU pool as soon as it arrives
+        articles_chunks = [load_cached(article) for article in articles_data]
+        downloads = {scheduler.io.submit(download, article): i for i, article in enumerate(articles_data) if articles_chunks[i] is None}
+        parses = {}
+        for future in concurrent.futures.as_completed(downloads):
+            i = downloads[future]
+            content = future.result()
+            if content is None:
+                articles_chunks[i] = []
+            else:
+                parses[i] = scheduler.cpu.submit(parse, articles_data[i], content)
+        for i, future in parses.items():
+            articles_chunks[i] = future.result()
+
+        chunks = [chunk_data for article_chunks in articles_chunks for chunk_data in article_chunks]
+        if not chunks:
+            return []
+
+        embeddings = get_embedding_service(self.model)
+        missing = [chunk_data for chunk_data in chunks if chunk_data['embedding'] is None]
+        if missing:
+            with span("DeepSearch.encode", chunks=len(missing)):
+                encoded = scheduler.cpu.submit(embeddings.encode, [chunk_data['chunk_text'] for chunk_data in missing], batch_size=32).result()
+            for chunk_data, embedding in zip(missing, encoded):
+                chunk_data['embedding'] = embedding
+
+            if self.paper_cache is not None:
+                missing_ids = {id(chunk_data) for chunk_data in missing}
+                for article, article_chunks in zip(articles_data, articles_chunks):
+                    if any(id(chunk_data) in missing_ids for chunk_data in article_chunks):
+                        self.paper_cache.save_embeddings(article.get('arxiv_id'), [chunk_data['embedding'] for chunk_data in article_chunks])
+
+        self.papers = [(article.get('arxiv_id'), article_chunks) for article, article_chunks in zip(articles_data, articles_chunks) if article_chunks]
+
+        matrix = np.vstack([chunk_data['embedding'] for chunk_data in chunks]).astype('float32')
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        query_embedding = embeddings.encode(self.query).astype('float32')
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        scores = matrix @ query_embedding
+
+        k = min(self.k_chunks, len(chunks))
+        annotate(articles=len(articles_data), chunks=len(chunks), k=k)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [chunks[i] for i in top]
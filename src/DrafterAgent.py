@@ -1,14 +1,22 @@
 import json
+from src.LLMCache import llm_cache
+from src.Tracing import annotate, traced, usage_attributes
 
 class DrafterAgent:
-    def __init__(self, client, chunks, query, answer, temperature=0.1, deployment="medical-device-research-model"):
+    # Bump whenever a prompt changes so cached outputs of the old prompt are not reused
+    assess_prompt_version = 1
+    refine_prompt_version = 1
+
+    def __init__(self, client, chunks, query, answer, temperature=0.1, deployment="medical-device-research-model", context=None):
         self.client = client
+        self.context = context
         self.chunks = chunks
         self.query = query
         self.answer = answer
         self.temperature = temperature
         self.deployment = deployment
 
+    @traced("DrafterAgent.assess")
     def assess(self):
         chunks_text = '\n'.join([f"- {chunk['chunk_text'][:200]}..." for chunk in self.chunks])
         
@@ -31,6 +39,13 @@ Respond ONLY with JSON:
     "insufficient_context": true/false,
     "assessment_summary": "brief explanation"
 }}"""
+
+        # The prompt holds the whole (query, answer, context) triple, so identical prompts get identical assessments
+        cache_scope = {'prompt_version': self.assess_prompt_version, 'deployment': self.deployment, 'temperature': self.temperature}
+        assessment = llm_cache.get("assessment", cache_scope, prompt)
+        if assessment is not None:
+            annotate(chunks=len(self.chunks), cached=True)
+            return assessment
         
         response = self.client.chat.completions.create(
             model=self.deployment,
@@ -41,16 +56,23 @@ Respond ONLY with JSON:
             temperature=self.temperature
         )
 
+        annotate(chunks=len(self.chunks), cached=False, **usage_attributes(response))
         try:
-            return json.loads(response.choices[0].message.content.strip())
+            assessment = json.loads(response.choices[0].message.content.strip())
         except:
+            annotate(parse_error=True)
             return {"needs_grounding": False, "needs_query_focus": False, "sufficient_context": True}
+        llm_cache.put("assessment", cache_scope, prompt, assessment)
+        return assessment
     
+    @traced("DrafterAgent.draft")
     def draft(self, assessment):
         if not any([assessment.get("needs_grounding"), assessment.get("needs_query_focus"), assessment.get("insufficient_context")]):
+            annotate(skipped=True)
             return self.answer
                     
-        chunks_text = '\n'.join([f"- {chunk['chunk_text']}\nSource: {chunk.get('source', 'Unknown')}" 
+        # src.ContextBuilder output when the caller has it, otherwise the full chunks
+        chunks_text = self.context or '\n'.join([f"- {chunk['chunk_text']}\nSource: {chunk.get('source', 'Unknown')}" 
                                 for chunk in self.chunks])
         
         improvement_focus = []
@@ -87,4 +109,66 @@ Improved Answer:"""
             temperature=self.temperature
         )
         
-        return response.choices[0].message.content.strip()
\ No newline at end of file
+        annotate(skipped=False, **usage_attributes(response))
+        return response.choices[0].message.content.strip()
+
+    @traced("DrafterAgent.refine")
+    def refine(self):
+        """Assesses and rewrites the answer in one structured call, returns the answer unchanged when no rewrite is needed"""
+        chunks_text = self.context or '\n'.join([f"- {chunk['chunk_text']}" for chunk in self.chunks])
+
+        prompt = f"""Assess this answer against the query and the context, then rewrite it if it needs improvement.
+
+Query: {self.query}
+Current Answer: {self.answer}
+
+Available Context:
+{chunks_text}
+
+Assess:
+1. Is the answer well-grounded in the provided context?
+2. Does the answer directly address the query?
+3. Is the context sufficient to answer the query?
+
+If the answer needs grounding or query focus, write an improved answer that:
+- Bases the answer primarily on the provided context
+- Prioritizes the most relevant and recent information. The context is sorted by relevance where the most relevant information appears first.
+- Cites the source based on the metadata provided like author, year, title, etc. In the text you can use author and year. At the end of the answer, provide a list of sources with full metadata after saying 'Sources'.
+- States clearly if the context doesn't contain enough information
+- Is clear and well-structured
+
+Respond ONLY with JSON:
+{{
+    "needs_grounding": true/false,
+    "needs_query_focus": true/false,
+    "insufficient_context": true/false,
+    "assessment_summary": "brief explanation",
+    "improved_answer": "the rewritten answer, or an empty string if no rewrite is needed"
+}}"""
+
+        cache_scope = {'prompt_version': self.refine_prompt_version, 'deployment': self.deployment, 'temperature': self.temperature}
+        result = llm_cache.get("refinement", cache_scope, prompt)
+        if result is None:
+            response = self.client.chat.completions.create(
+                model=self.deployment,
+                messages=[
+                    {"role": "system", "content": "You are an expert evaluator and writer on medical diagnostic devices. Return only valid JSON."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=self.temperature,
+                response_format={"type": "json_object"}
+            )
+            annotate(cached=False, **usage_attributes(response))
+            try:
+                result = json.loads(response.choices[0].message.content.strip())
+            except ValueError:
+                annotate(parse_error=True)
+                return self.answer
+            llm_cache.put("refinement", cache_scope, prompt, result)
+        else:
+            annotate(cached=True)
+
+        improved = (result.get("improved_answer") or "").strip()
+        rewrite = any([result.get("needs_grounding"), result.get("needs_query_focus"), result.get("insufficient_context")])
+        annotate(chunks=len(self.chunks), rewritten=bool(rewrite and improved))
+        return improved if rewrite and improved else self.answer
@@ -0,0 +1,129 @@
+import concurrent.futures
+import queue
+import threading
+import time
+import numpy as np
+from src.Tracing import tracer
+
+class EmbeddingBatcher:
+    """Queues encode requests from every thread and runs them through the model as dynamic batches"""
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.requests_served = 0
+
+    def submit(self, texts, batch_size=32):
+        future = concurrent.futures.Future()
+        texts = list(texts)
+        if not texts:
+            future.set_result(np.zeros((0, 0), dtype='float32'))
+            return future
+        self.start()
+        if len(texts) <= self.max_batch_size:
+            self.requests.put((texts, batch_size, future))
+            return future
+
+        # Oversized requests are queued one slice at a time, so short requests that arrive meanwhile
+        # go into the next forward pass instead of waiting for the whole request
+        slices = [texts[i:i + self.max_batch_size] for i in range(0, len(texts), self.max_batch_size)]
+        results = []
+
+        def queue_next(done=None):
+            if done is not None:
+                try:
+                    results.append(done.result())
+                except Exception as e:
+                    future.set_exception(e)
+                    return
+            if len(results) == len(slices):
+                future.set_result(np.vstack(results))
+                return
+            part = concurrent.futures.Future()
+            part.add_done_callback(queue_next)
+            self.requests.put((slices[len(results)], batch_size, part))
+
+        queue_next()
+        return future
+
+    def encode(self, texts, batch_size=32):
+        return self.submit(texts, batch_size).result()
+
+    def start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="embedding-batcher", daemon=True)
+                self.worker.start()
+
+    def run(self):
+        held = None
+        while True:
+            pending = [held or self.requests.get()]
+            held = None
+            size = len(pending[0][0])
+            deadline = time.perf_counter() + self.max_wait
+
+            # An idle worker flushes a lone request immediately, requests arriving during that forward pass
+            # queue up and form the next batch. Only once others are queued does it wait up to max_wait_ms for more.
+            # A request that would take the batch past max_batch_size is held over to start the next one
+            while not self.requests.empty():
+                request = self.requests.get_nowait()
+                if size + len(request[0]) > self.max_batch_size:
+                    held = request
+                    break
+                pending.append(request)
+                size += len(request[0])
+
+            while held is None and len(pending) > 1 and size < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    held = request
+                    break
+                pending.append(request)
+                size += len(request[0])
+
+            self.flush(pending)
+
+    def flush(self, pending):
+        # Identical texts from different callers are encoded once
+        unique = {}
+        for texts, _, _ in pending:
+            for text in texts:
+                unique.setdefault(text, len(unique))
+        batch_size = max(request[1] for request in pending)
+
+        try:
+            with tracer.span("EmbeddingBatcher.flush", requests=len(pending), texts=len(unique)):
+                encoded = np.asarray(self.model.encode(list(unique), batch_size=batch_size), dtype='float32').reshape(len(unique), -1)
+        except Exception as e:
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+
+        with self.lock:
+            self.batches += 1
+            self.texts += len(unique)
+            self.requests_served += len(pending)
+        for texts, _, future in pending:
+            future.set_result(encoded[[unique[text] for text in texts]])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'texts': self.texts,
+                'requests': self.requests_served,
+                'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else 0.0,
+                'queued': self.requests.qsize()
+            }
@@ -0,0 +1,194 @@
+import contextvars
+import hashlib
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import numpy as np
+from src.EmbeddingBatcher import EmbeddingBatcher
+from src.util import write_file
+
+request_vectors = ContextVar("request_vectors", default=None)
+
+class EmbeddingService:
+    def __init__(self, model, model_name, max_entries=4096, cache_dir=None, max_batch_size=None, max_wait_ms=5):
+        self.model = model
+        # Misses from concurrent sessions share forward passes when batching is enabled
+        self.batcher = EmbeddingBatcher(model, max_batch_size, max_wait_ms) if max_batch_size else None
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.request_hits = 0
+        self.misses = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def encode(self, texts, batch_size=32):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+
+        keys = [self.key(text) for text in texts]
+        vectors = [self.lookup(key) for key in keys]
+
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+
+        if missing:
+            positions = list(missing.values())
+            missing_texts = [texts[indices[0]] for indices in positions]
+            if self.batcher is not None:
+                encoded = self.batcher.encode(missing_texts, batch_size=batch_size)
+            else:
+                encoded = self.model.encode(missing_texts, batch_size=batch_size)
+            encoded = np.asarray(encoded, dtype='float32').reshape(len(positions), -1)
+            for key, indices, vector in zip(missing.keys(), positions, encoded):
+                vector.setflags(write=False)
+                self.store(key, vector)
+                for i in indices:
+                    vectors[i] = vector
+            with self.lock:
+                self.misses += len(positions)
+
+        if single:
+            return vectors[0]
+        if not vectors:
+            return np.zeros((0, 0), dtype='float32')
+        return np.vstack(vectors)
+
+    def lookup(self, key):
+        scope = request_vectors.get()
+        if scope is not None and key in scope:
+            with self.lock:
+                self.request_hits += 1
+            return scope[key]
+
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+        if vector is not None:
+            self.remember(key, vector, scope)
+            return vector
+
+        vector = self.load_from_disk(key)
+        if vector is not None:
+            with self.lock:
+                self.disk_hits += 1
+            self.remember(key, vector, scope)
+        return vector
+
+    def store(self, key, vector):
+        self.remember(key, vector, request_vectors.get())
+        self.save_to_disk(key, vector)
+
+    def remember(self, key, vector, scope=None):
+        if scope is not None:
+            scope[key] = vector
+        with self.lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def load_from_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            vector = np.load(self.disk_path(key))
+        except (OSError, ValueError):
+            return None
+        vector.setflags(write=False)
+        return vector
+
+    def save_to_disk(self, key, vector):
+        if not self.cache_dir:
+            return
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, lambda f: np.save(f, vector))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'request_hits': self.request_hits,
+                'misses': self.misses,
+                'size': len(self.memory)
+            }
+        if self.batcher is not None:
+            stats['batcher'] = self.batcher.stats()
+        return stats
+
+services = {}
+
+def register_embedding_service(model, model_name, max_entries=4096, cache_dir=None, max_batch_size=None, max_wait_ms=5):
+    service = EmbeddingService(model, model_name, max_entries=max_entries, cache_dir=cache_dir, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    services[id(model)] = service
+    return service
+
+def get_embedding_service(model):
+    if isinstance(model, EmbeddingService):
+        return model
+    service = services.get(id(model))
+    if service is None:
+        # Unregistered models have no stable name, so they only get the in-memory tier
+        service = EmbeddingService(model, f"{type(model).__name__}-{id(model)}")
+        services[id(model)] = service
+    return service
+
+@contextmanager
+def request_scope():
+    # Vectors computed inside the scope stay available for the whole request regardless of LRU evictions
+    token = request_vectors.set({})
+    try:
+        yield request_vectors.get()
+    finally:
+        request_vectors.reset(token)
+
+def with_request_scope(func):
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            # Each step runs in a private context so the scope survives across yields to the caller
+            context = contextvars.copy_context()
+            context.run(request_vectors.set, {})
+            generator = context.run(func, *args, **kwargs)
+            try:
+                while True:
+                    try:
+                        value = context.run(next, generator)
+                    except StopIteration as stop:
+                        return stop.value
+                    yield value
+            finally:
+                context.run(generator.close)
+        return generator_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with request_scope():
+            return func(*args, **kwargs)
+    return wrapper
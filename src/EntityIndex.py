@@ -0,0 +1,61 @@
+import numpy as np
+
+class EntityIndex:
+    def __init__(self, entity_names, offsets, postings):
+        self.entity_names = entity_names
+        self.entity_ids = {name: i for i, name in enumerate(entity_names)}
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def from_arrays(cls, entity_names, entity_offsets, entity_ids):
+        # Invert the chunk -> entity CSR arrays; a chunk appears once per occurrence of the entity
+        chunk_ids = np.repeat(np.arange(len(entity_offsets) - 1, dtype=np.int32), np.diff(entity_offsets))
+        order = np.argsort(entity_ids, kind='stable')
+        counts = np.bincount(entity_ids, minlength=len(entity_names))
+        offsets = np.zeros(len(entity_names) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(entity_names, offsets, chunk_ids[order])
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        entity_names, entity_index = [], {}
+        entity_offsets, entity_ids = [0], []
+        for chunk in chunks:
+            for entity in chunk['entities']:
+                if entity not in entity_index:
+                    entity_index[entity] = len(entity_names)
+                    entity_names.append(entity)
+                entity_ids.append(entity_index[entity])
+            entity_offsets.append(len(entity_ids))
+        return cls.from_arrays(entity_names, np.asarray(entity_offsets, dtype=np.int64), np.asarray(entity_ids, dtype=np.int32))
+
+    @classmethod
+    def build(cls, dictionary):
+        if hasattr(dictionary, 'entity_ids'):
+            return cls.from_arrays(dictionary.entity_names, np.asarray(dictionary.entity_offsets), np.asarray(dictionary.entity_ids))
+        return cls.from_chunks(dictionary)
+
+    def tag_ids(self, tags):
+        return np.fromiter((self.entity_ids[tag] for tag in tags if tag in self.entity_ids), dtype=np.int64)
+
+    def match_counts(self, chunk_ids, tags):
+        # Equivalent to sum(entities.count(tag) for tag in tags) for every candidate chunk at once
+        candidates = np.asarray(chunk_ids, dtype=np.int64)
+        counts = np.zeros(len(candidates), dtype=np.int64)
+        tag_ids, tag_weights = np.unique(self.tag_ids(tags), return_counts=True)
+        if len(candidates) == 0 or len(tag_ids) == 0:
+            return counts
+
+        lengths = self.offsets[tag_ids + 1] - self.offsets[tag_ids]
+        hits = np.concatenate([self.postings[self.offsets[i]:self.offsets[i + 1]] for i in tag_ids])
+        weights = np.repeat(tag_weights, lengths)
+
+        order = np.argsort(candidates)
+        sorted_candidates = candidates[order]
+        positions = np.searchsorted(sorted_candidates, hits)
+        valid = positions < len(sorted_candidates)
+        valid[valid] = sorted_candidates[positions[valid]] == hits[valid]
+
+        counts[order] = np.bincount(positions[valid], weights=weights[valid], minlength=len(candidates)).astype(np.int64)
+        return counts
@@ -1,46 +1,79 @@
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
 import numpy as np
-import concurrent.futures
-from src.util import cosine_similarity
 from src.DrafterAgent import DrafterAgent
+from src.EmbeddingService import get_embedding_service
+from src.Tracing import annotate, traced
 
 class Evaluation:
-    def __init__(self, chunks, query, sentence_transformer_model, client):
+    def __init__(self, chunks, query, sentence_transformer_model, client, vector_db=None, context=None):
         self.chunks = chunks
+        # The budgeted context the answer was generated from, reused for the refinement prompt
+        self.context = context
         self.query = query
         self.sentence_transformer_model = sentence_transformer_model
         self.chunk_answer_similarity = 0
         self.chunk_query_similarity = 0
         self.query_answer_similarity = 0
         self.client = client
+        self.vector_db = vector_db
+        self.chunk_vectors = None
+        self.query_embedding = None
 
+    @traced("Evaluation.evaluate")
     def evaluate(self, answer):
-        self.query_embedding = self.sentence_transformer_model.encode(self.query, convert_to_tensor=True).cpu().numpy().astype('float32')
-        self.answer_embedding = self.sentence_transformer_model.encode(answer, convert_to_tensor=True).cpu().numpy().astype('float32')
+        embeddings = get_embedding_service(self.sentence_transformer_model)
+        if self.query_embedding is None:
+            self.query_embedding = normalize_rows(embeddings.encode(self.query))[0]
+        self.answer_embedding = normalize_rows(embeddings.encode(answer))[0]
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            chunk_query_futures = {executor.submit(cosine_similarity, self.sentence_transformer_model.encode(chunk["chunk_text"], convert_to_tensor=True).cpu().numpy().astype('float32'), self.query_embedding) for chunk in self.chunks}
-            chunk_answer_futures = {executor.submit(cosine_similarity, self.sentence_transformer_model.encode(chunk["chunk_text"], convert_to_tensor=True).cpu().numpy().astype('float32'), self.answer_embedding) for chunk in self.chunks}
-            query_answer_future = executor.submit(cosine_similarity, self.query_embedding, self.answer_embedding)
-
-            chunk_query_similarities = [future.result() for future in concurrent.futures.as_completed(chunk_query_futures)]
-            chunk_answer_similarities = [future.result() for future in concurrent.futures.as_completed(chunk_answer_futures)]
-            query_answer_similarity = query_answer_future.result()
-
-        self.chunk_answer_similarity = max(chunk_answer_similarities)
-        self.chunk_query_similarity = max(chunk_query_similarities)
-        self.query_answer_similarity = query_answer_similarity
+        chunk_vectors = self.get_chunk_vectors()
+        if len(chunk_vectors):
+            # Column 0 holds chunk-query and column 1 chunk-answer similarities
+            similarities = chunk_vectors @ np.stack([self.query_embedding, self.answer_embedding], axis=1)
+            self.chunk_query_similarity, self.chunk_answer_similarity = (float(value) for value in similarities.max(axis=0))
+        else:
+            self.chunk_query_similarity, self.chunk_answer_similarity = 0.0, 0.0
+        self.query_answer_similarity = float(self.query_embedding @ self.answer_embedding)
 
         average = (self.chunk_answer_similarity + self.chunk_query_similarity + self.query_answer_similarity) / 3
+        annotate(chunks=len(self.chunks), score=round(average, 4))
 
         return average
 
+    def get_chunk_vectors(self):
+        # Chunk vectors are gathered once per evaluator and reused when the drafted answer is scored
+        if self.chunk_vectors is not None:
+            return self.chunk_vectors
+
+        vectors = [self.stored_chunk_vector(chunk) for chunk in self.chunks]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = get_embedding_service(self.sentence_transformer_model).encode([self.chunks[i]["chunk_text"] for i in missing])
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+
+        self.chunk_vectors = normalize_rows(np.vstack(vectors)) if vectors else np.zeros((0, 0), dtype='float32')
+        return self.chunk_vectors
+
+    def stored_chunk_vector(self, chunk):
+        if chunk.get("embedding") is not None:
+            return np.asarray(chunk["embedding"], dtype='float32').reshape(-1)
+        if self.vector_db is not None and chunk.get("chunk_id") is not None:
+            try:
+                return self.vector_db.reconstruct(int(chunk["chunk_id"]))
+            except RuntimeError:
+                return None
+        return None
+
+    @traced("Evaluation.drafting")
     def drafting(self, answer):
-        Agent = DrafterAgent(self.client, self.chunks, self.query, answer, temperature=0.25)
+        Agent = DrafterAgent(self.client, self.chunks, self.query, answer, temperature=0.25, context=self.context)
         assessment = Agent.assess()
         return Agent.draft(assessment)
 
+    @traced("Evaluation.refine")
+    def refine(self, answer):
+        return DrafterAgent(self.client, self.chunks, self.query, answer, temperature=0.25, context=self.context).refine()
+
     def format_evaluation_results(self):
         if not self.chunk_query_similarity and not self.chunk_answer_similarity and not self.query_answer_similarity:
             return ""
@@ -75,3 +108,9 @@ class Evaluation:
             formatted_text += f"**Answer Quality:** 🔴 Poor - {self.query_answer_similarity:.3f}\n"
 
         return formatted_text
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype='float32').reshape(-1, np.shape(vectors)[-1])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
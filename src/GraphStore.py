@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import numpy as np
+from src.util import write_file
+
+class CSRGraph:
+    def __init__(self, names, offsets, neighbors):
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.offsets = offsets
+        self.neighbor_array = neighbors
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        # Memory-mapped arrays let several worker processes share one copy through the page cache
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, "nodes.json"), "r") as f:
+            names = json.load(f)
+        offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode=mmap_mode)
+        neighbors = np.load(os.path.join(directory, "neighbors.npy"), mmap_mode=mmap_mode)
+        return cls(names, offsets, neighbors)
+
+    def number_of_nodes(self):
+        return len(self.names)
+
+    def has_node(self, node):
+        return node in self.ids
+
+    def neighbor_ids(self, node_id):
+        return self.neighbor_array[self.offsets[node_id]:self.offsets[node_id + 1]]
+
+    def neighbors(self, node):
+        return (self.names[i] for i in self.neighbor_ids(self.ids[node]))
+
+    def common_neighbors(self, u, v):
+        u_id, v_id = self.ids[u], self.ids[v]
+        # Neighbor lists are stored sorted and deduplicated, which is what intersect1d needs for assume_unique
+        shared = np.intersect1d(self.neighbor_ids(u_id), self.neighbor_ids(v_id), assume_unique=True)
+        return (self.names[i] for i in shared if i != u_id and i != v_id)
+
+def convert_graph(graph, out_dir):
+    names = [str(node) for node in graph.nodes()]
+    ids = {node: i for i, node in enumerate(graph.nodes())}
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int32)
+    neighbor_lists = []
+    for i, node in enumerate(graph.nodes()):
+        node_neighbors = np.unique(np.fromiter((ids[neighbor] for neighbor in graph.neighbors(node)), dtype=np.int32))
+        neighbor_lists.append(node_neighbors)
+        offsets[i + 1] = offsets[i] + len(node_neighbors)
+    neighbors = np.concatenate(neighbor_lists).astype(np.int32) if neighbor_lists else np.zeros(0, dtype=np.int32)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "nodes.json"), "w") as f:
+        json.dump(names, f)
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, "neighbors.npy"), neighbors)
+    return len(names), len(neighbors)
+
+def append_edges(directory, edges):
+    """Merges (source, target) edges into a stored graph, creating nodes that do not exist yet"""
+    if os.path.exists(os.path.join(directory, "offsets.npy")):
+        graph = CSRGraph.load(directory, mmap=False)
+        names, ids = list(graph.names), dict(graph.ids)
+    else:
+        graph, names, ids = None, [], {}
+    existing_count = len(names)
+
+    added = {}
+    for source, target in edges:
+        for node in (source, target):
+            if node not in ids:
+                ids[node] = len(names)
+                names.append(node)
+        added.setdefault(ids[source], set()).add(ids[target])
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int32)
+    neighbor_lists = []
+    for i in range(len(names)):
+        node_neighbors = graph.neighbor_ids(i) if i < existing_count else np.zeros(0, dtype=np.int32)
+        if i in added:
+            node_neighbors = np.union1d(node_neighbors, np.fromiter(added[i], dtype=np.int32)).astype(np.int32)
+        neighbor_lists.append(node_neighbors)
+        offsets[i + 1] = offsets[i] + len(node_neighbors)
+    neighbors = np.concatenate(neighbor_lists).astype(np.int32) if neighbor_lists else np.zeros(0, dtype=np.int32)
+
+    # Files are replaced atomically so a running app that memory-mapped the old ones keeps a consistent view
+    os.makedirs(directory, exist_ok=True)
+    write_file(os.path.join(directory, "nodes.json"), lambda f: f.write(json.dumps(names).encode("utf-8")))
+    write_file(os.path.join(directory, "offsets.npy"), lambda f: np.save(f, offsets))
+    write_file(os.path.join(directory, "neighbors.npy"), lambda f: np.save(f, neighbors))
+    return len(names), len(neighbors)
+
+def convert_gexf(gexf_path, out_dir):
+    import networkx as nx
+    return convert_graph(nx.read_gexf(gexf_path), out_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a GEXF knowledge graph into the memory-mappable CSR format")
+    parser.add_argument("gexf_path")
+    parser.add_argument("out_dir")
+    args = parser.parse_args()
+
+    node_count, edge_count = convert_gexf(args.gexf_path, args.out_dir)
+    print(f"Wrote {node_count} nodes and {edge_count} adjacency entries to {args.out_dir}")
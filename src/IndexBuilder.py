@@ -0,0 +1,106 @@
+import argparse
+import os
+import time
+import numpy as np
+import faiss
+
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "fp16"]
+
+def build_index(vectors, index_type, nlist=None, pq_m=48, pq_nbits=8, hnsw_m=32):
+    # Every variant keeps the L2 metric of the original index so scores stay comparable
+    n, d = vectors.shape
+    nlist = nlist or max(1, min(int(4 * np.sqrt(n)), n // 39 or 1))
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, nlist)
+    elif index_type == "ivf_pq":
+        # Each PQ codebook needs more training points than centroids
+        pq_nbits = min(pq_nbits, int(np.log2(max(n // 39, 2))))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, pq_m, pq_nbits)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit)
+    elif index_type == "fp16":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16)
+    else:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    if index_type.startswith("ivf"):
+        # Evaluation and the corpus promoter reconstruct vectors by chunk id, IVF needs a direct map for that
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index
+
+def search_parameters(index, nprobe=None, ef_search=None):
+    if not isinstance(index, faiss.Index):
+        # src.CorpusPromoter.PromotedIndex wraps the shipped index, the parameters are for that one
+        index = index.base_index
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF) and nprobe:
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if isinstance(index, faiss.IndexHNSW) and ef_search:
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+def evaluate_index(index, queries, exact_ids, k, params=None):
+    found_ids = index.search(queries, k, params=params)[1]
+    recall = np.mean([len(set(found[found >= 0]) & set(exact)) / k for found, exact in zip(found_ids, exact_ids)])
+
+    # One query per call, as ContextRetrieval issues them
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query.reshape(1, -1), k, params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'recall': float(recall),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'bytes': len(faiss.serialize_index(index))
+    }
+
+def sample_queries(vectors, count, noise=0.05, seed=0):
+    # Perturbed corpus vectors stand in for real queries, which land near but not on a chunk
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(count, len(vectors)), replace=False)].copy()
+    queries += rng.normal(scale=noise, size=queries.shape).astype('float32')
+    faiss.normalize_L2(queries)
+    return queries
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the corpus index as approximate or quantized variants and report recall@k, latency and size")
+    parser.add_argument("index_path", help="Existing exact index, e.g. 'data/chunks(1).index'")
+    parser.add_argument("--types", nargs="+", default=INDEX_TYPES[1:], choices=INDEX_TYPES)
+    parser.add_argument("--out-dir", default="data/indexes")
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--ef-search", type=int, default=64)
+    args = parser.parse_args()
+
+    exact = faiss.read_index(args.index_path)
+    vectors = exact.reconstruct_n(0, exact.ntotal)
+    queries = sample_queries(vectors, args.queries)
+    exact_ids = exact.search(queries, args.k)[1]
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    print(f"{'type':<10}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}{'size MB':>10}")
+    report = evaluate_index(exact, queries, exact_ids, args.k)
+    print(f"{'exact':<10}{report['recall']:>12.3f}{report['p50_ms']:>10.3f}{report['p95_ms']:>10.3f}{report['bytes'] / 1e6:>10.2f}")
+
+    for index_type in args.types:
+        index = build_index(vectors, index_type, nlist=args.nlist)
+        params = search_parameters(index, nprobe=args.nprobe, ef_search=args.ef_search)
+        report = evaluate_index(index, queries, exact_ids, args.k, params=params)
+        print(f"{index_type:<10}{report['recall']:>12.3f}{report['p50_ms']:>10.3f}{report['p95_ms']:>10.3f}{report['bytes'] / 1e6:>10.2f}")
+        faiss.write_index(index, os.path.join(args.out_dir, f"{index_type}.index"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+import numpy as np
+import faiss
+import nltk
+from PyPDF2 import PdfReader
+from src.CorpusStore import CorpusStore, append_chunks, convert_json
+from src.DeepSearch import chunk_sentences, extract_pdf_text, load_nltk
+from src.GraphStore import append_edges, convert_gexf
+from src.util import write_file
+
+DEFAULT_MODEL = 'pritamdeka/S-BioBert-snli-multinli-stsb'
+ARXIV_ID_PATTERN = re.compile(r'^\d{4}\.\d{4,5}(v\d+)?$')
+
+nlp = None
+
+def init_worker(spacy_model):
+    # Each worker process loads spaCy and the NLTK tokenizer once
+    global nlp
+    import spacy
+    nlp = spacy.load(spacy_model)
+    load_nltk()
+
+def process_pdf(path, chunk_size_sentences):
+    """Runs in a worker process: extract, chunk and tag one PDF"""
+    reader = PdfReader(path)
+    text = extract_pdf_text(reader)
+    metadata = pdf_metadata(path, reader, text)
+
+    chunks = []
+    for chunk_text, _ in chunk_sentences(nltk.sent_tokenize(text), chunk_size_sentences):
+        entities, triples = tag_chunk(nlp(chunk_text))
+        chunks.append({
+            'text': chunk_text,
+            'metadata': metadata,
+            'entities': entities,
+            'triples': triples
+        })
+    return chunks
+
+def tag_chunk(doc):
+    triples = extract_triples(doc)
+    entities = {ent.text for ent in doc.ents}
+    for subject, _, obj in triples:
+        entities.update((subject, obj))
+    return sorted(entities), triples
+
+def extract_triples(doc):
+    # Subject -> object edges labelled with the verb lemma, the same shape as the shipped knowledge graph
+    triples = []
+    for token in doc:
+        if "subj" not in token.dep_:
+            continue
+        verb = token.head
+        for child in verb.children:
+            objects = [child] if "obj" in child.dep_ else [grandchild for grandchild in child.children if child.dep_ == "prep" and "obj" in grandchild.dep_]
+            for obj in objects:
+                triples.append((token.text, verb.lemma_, obj.text))
+    return triples
+
+def pdf_metadata(path, reader, text):
+    info = reader.metadata or {}
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    title = (info.get('/Title') or "").strip() or stem
+    author = (info.get('/Author') or "").strip()
+    authors = [name.strip() for name in re.split(r',|;| and ', author) if name.strip()] or ["Unknown Author"]
+    try:
+        published = reader.metadata.creation_date.strftime("%Y-%m-%d")
+    except Exception:
+        published = "Unknown Date"
+    abstract = re.search(r'Abstract[\s.:\-—]*(.{50,1500}?)(?:\n\n|\s(?:1\.?\s*)?Introduction|Keywords|Index Terms)', text, flags=re.IGNORECASE | re.DOTALL)
+
+    metadata = {
+        'title': title,
+        'authors': authors,
+        'published': published,
+        'summary': abstract.group(1).strip() if abstract else "No summary available"
+    }
+    if ARXIV_ID_PATTERN.match(stem):
+        metadata['arxiv_id'] = stem
+    return metadata
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'files': {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    write_file(path, lambda f: f.write(json.dumps(manifest, indent=2).encode("utf-8")))
+
+def write_index(index, path):
+    write_file(path, lambda f: faiss.write_index(index, faiss.PyCallbackIOWriter(f.write)))
+
+def load_promoted(path):
+    # Chunks promoted by deep search (src.CorpusPromoter), ordered by their corpus ids
+    if not path or not os.path.exists(path):
+        return np.zeros(0, dtype=np.int64), None
+    promoted = faiss.read_index(path)
+    ids = faiss.vector_to_array(promoted.id_map)
+    vectors = promoted.index.reconstruct_n(0, promoted.ntotal)
+    order = np.argsort(ids)
+    return ids[order], vectors[order]
+
+def pending_files(pdf_dir, manifest):
+    ingested_hashes = {entry['sha256'] for entry in manifest['files'].values()}
+    pending = []
+    for name in sorted(os.listdir(pdf_dir)):
+        if not name.lower().endswith(".pdf"):
+            continue
+        path = os.path.join(pdf_dir, name)
+        sha256 = file_hash(path)
+        # Unchanged files and copies of already ingested files are skipped
+        if sha256 not in ingested_hashes:
+            pending.append((path, sha256))
+            ingested_hashes.add(sha256)
+    return pending
+
+def ingest(pdf_dir, corpus_dir, index_path, graph_dir, manifest_path, index_dir=None, corpus_json=None, gexf_path=None,
+           model_name=DEFAULT_MODEL, spacy_model="en_core_web_sm", workers=None, chunk_size_sentences=10, batch_size=64,
+           promoted_path=None):
+    manifest = load_manifest(manifest_path)
+    pending = pending_files(pdf_dir, manifest)
+    if not pending:
+        print("Nothing to ingest, every PDF is already in the manifest")
+        return 0
+
+    # The first incremental run starts from the shipped JSON and GEXF exports when the columnar stores are missing
+    if not os.path.exists(os.path.join(corpus_dir, "text_offsets.npy")) and corpus_json and os.path.exists(corpus_json):
+        convert_json(corpus_json, corpus_dir)
+    if not os.path.exists(os.path.join(graph_dir, "offsets.npy")) and gexf_path and os.path.exists(gexf_path):
+        convert_gexf(gexf_path, graph_dir)
+
+    index = faiss.read_index(index_path) if os.path.exists(index_path) else None
+    base_size = index.ntotal if index is not None else 0
+    promoted_ids, promoted_vectors = load_promoted(promoted_path)
+    index_size = base_size + len(promoted_ids)
+    corpus_size = len(CorpusStore.load(corpus_dir)) if os.path.exists(os.path.join(corpus_dir, "text_offsets.npy")) else 0
+    if index_size != corpus_size:
+        raise SystemExit(f"{index_path} holds {index_size} vectors but {corpus_dir} holds {corpus_size} chunks, rebuild before ingesting")
+    if not np.array_equal(promoted_ids, np.arange(base_size, index_size)):
+        raise SystemExit(f"{promoted_path} does not continue {index_path}, rebuild before ingesting")
+
+    print(f"Processing {len(pending)} PDFs...")
+    file_chunks = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(spacy_model,)) as executor:
+        futures = {executor.submit(process_pdf, path, chunk_size_sentences): path for path, _ in pending}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                file_chunks[path] = future.result()
+                print(f"  {os.path.basename(path)}: {len(file_chunks[path])} chunks")
+            except Exception as e:
+                print(f"  {os.path.basename(path)}: failed, {str(e)}")
+
+    ingested = [(path, sha256) for path, sha256 in pending if file_chunks.get(path)]
+    chunks = [chunk for path, _ in ingested for chunk in file_chunks[path]]
+    if not chunks:
+        print("No chunks extracted")
+        return 0
+
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device='cpu')
+    vectors = np.asarray(model.encode([chunk['text'] for chunk in chunks], batch_size=batch_size), dtype='float32')
+    faiss.normalize_L2(vectors)
+    # Promoted chunks are folded into the base index ahead of the new ones, keeping ids equal to corpus rows
+    if promoted_vectors is not None:
+        vectors = np.vstack([promoted_vectors, vectors])
+
+    first_chunk_id = append_chunks([{key: chunk[key] for key in ('text', 'metadata', 'entities')} for chunk in chunks], corpus_dir)
+    if index is None:
+        index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    write_index(index, index_path)
+
+    # Approximate variants from src.IndexBuilder are trained already, so new vectors are simply added
+    if index_dir and os.path.isdir(index_dir):
+        for name in sorted(os.listdir(index_dir)):
+            if name.endswith(".index"):
+                variant_path = os.path.join(index_dir, name)
+                variant = faiss.read_index(variant_path)
+                if variant.ntotal == base_size:
+                    variant.add(vectors)
+                    write_index(variant, variant_path)
+                else:
+                    print(f"Skipped {variant_path}, it holds {variant.ntotal} vectors instead of {base_size}")
+    if promoted_vectors is not None:
+        os.remove(promoted_path)
+
+    edges = []
+    for offset, chunk in enumerate(chunks):
+        chunk_id = first_chunk_id + offset
+        edges.extend((f"chunk{chunk_id}_subj_{subject}", f"chunk{chunk_id}_obj_{obj}") for subject, _, obj in chunk['triples'])
+    append_edges(graph_dir, edges)
+
+    chunk_id = first_chunk_id
+    ingested_at = datetime.now().isoformat(timespec="seconds")
+    for path, sha256 in ingested:
+        previous = manifest['files'].get(path)
+        entry = {'sha256': sha256, 'first_chunk': chunk_id, 'chunk_count': len(file_chunks[path]), 'ingested_at': ingested_at}
+        if previous is not None:
+            # Rows are append only, chunks of the old version stay searchable until a full rebuild
+            entry['retired_chunks'] = previous.get('retired_chunks', []) + [[previous['first_chunk'], previous['chunk_count']]]
+        manifest['files'][path] = entry
+        chunk_id += len(file_chunks[path])
+    save_manifest(manifest_path, manifest)
+
+    print(f"Ingested {len(chunks)} chunks from {len(ingested)} PDFs, the corpus now holds {index.ntotal} chunks")
+    return len(chunks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally add a directory of PDFs to the FAISS index, corpus store and knowledge graph")
+    parser.add_argument("pdf_dir")
+    parser.add_argument("--corpus-dir", default=os.getenv("CORPUS_DIR", "data/corpus"))
+    parser.add_argument("--index", default="data/chunks(1).index")
+    parser.add_argument("--index-dir", default=os.getenv("FAISS_INDEX_DIR", "data/indexes"))
+    parser.add_argument("--graph-dir", default=os.getenv("KNOWLEDGE_GRAPH_DIR", "data/knowledge_graph"))
+    parser.add_argument("--corpus-json", default="data/chunks_with_entities(1).json")
+    parser.add_argument("--gexf", default="data/knowledge_graph(3).gexf")
+    parser.add_argument("--manifest", default="data/ingest_manifest.json")
+    parser.add_argument("--promoted-index", default=os.getenv("PROMOTED_INDEX", "data/promoted.index"))
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--spacy-model", default="en_core_web_sm")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-sentences", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    ingest(
+        args.pdf_dir, args.corpus_dir, args.index, args.graph_dir, args.manifest,
+        index_dir=args.index_dir, corpus_json=args.corpus_json, gexf_path=args.gexf,
+        model_name=args.model, spacy_model=args.spacy_model, workers=args.workers,
+        chunk_size_sentences=args.chunk_sentences, batch_size=args.batch_size,
+        promoted_path=args.promoted_index
+    )
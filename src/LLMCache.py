@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from src.CacheDB import normalize_query
+from src.util import write_file
+
+class Namespace:
+    """Entries of one kind of call made with one prompt version, deployment and temperature"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.matrix = None
+        self.matrix_keys = []
+        os.makedirs(directory, exist_ok=True)
+
+        # Oldest first, so file modification times restore the LRU order across restarts
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".json")]
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if entry.get('embedding') is not None:
+                entry['embedding'] = np.asarray(entry['embedding'], dtype='float32')
+            self.entries[os.path.basename(path)[:-5]] = entry
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def touch(self, key):
+        self.entries.move_to_end(key)
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+
+    def vectors(self):
+        # Rebuilt lazily after the entries change
+        if self.matrix is None:
+            self.matrix_keys = [key for key, entry in self.entries.items() if entry.get('embedding') is not None]
+            if self.matrix_keys:
+                self.matrix = np.vstack([self.entries[key]['embedding'] for key in self.matrix_keys])
+                self.matrix /= np.maximum(np.linalg.norm(self.matrix, axis=1, keepdims=True), 1e-12)
+            else:
+                self.matrix = np.zeros((0, 0), dtype='float32')
+        return self.matrix_keys, self.matrix
+
+class LLMCache:
+    """Persistent cache of intermediate LLM outputs, looked up by normalized text and then by embedding similarity"""
+    def __init__(self, cache_dir, max_entries=2048, threshold=0.95):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.namespaces = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def namespace(self, kind, scope):
+        name = f"{kind}-{hashlib.sha256(json.dumps(scope, sort_keys=True).encode('utf-8')).hexdigest()[:16]}"
+        if name not in self.namespaces:
+            self.namespaces[name] = Namespace(os.path.join(self.cache_dir, name))
+        return self.namespaces[name]
+
+    def key(self, text):
+        return hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+
+    def get(self, kind, scope, text):
+        if not self.cache_dir:
+            return None
+        key = self.key(text)
+        with self.lock:
+            namespace = self.namespace(kind, scope)
+            entry = namespace.entries.get(key)
+            if entry is None:
+                return None
+            namespace.touch(key)
+            self.hits += 1
+            return entry['output']
+
+    def search(self, kind, scope, embedding):
+        """Output of the most similar cached text above the threshold"""
+        if not self.cache_dir:
+            return None
+        vector = np.asarray(embedding, dtype='float32').reshape(-1)
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+        with self.lock:
+            namespace = self.namespace(kind, scope)
+            keys, matrix = namespace.vectors()
+            if not keys or matrix.shape[1] != len(vector):
+                return None
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            namespace.touch(keys[best])
+            self.semantic_hits += 1
+            return namespace.entries[keys[best]]['output']
+
+    def put(self, kind, scope, text, output, embedding=None):
+        """Stores the output of a call that missed the cache"""
+        if not self.cache_dir:
+            return
+        key = self.key(text)
+        entry = {
+            'text': text,
+            'output': output,
+            'embedding': np.asarray(embedding, dtype='float32').reshape(-1) if embedding is not None else None
+        }
+        with self.lock:
+            self.misses += 1
+            namespace = self.namespace(kind, scope)
+            stored = dict(entry, embedding=entry['embedding'].tolist() if embedding is not None else None)
+            write_file(namespace.path(key), lambda f: f.write(json.dumps(stored).encode("utf-8")))
+
+            namespace.entries[key] = entry
+            namespace.entries.move_to_end(key)
+            while len(namespace.entries) > self.max_entries:
+                evicted, _ = namespace.entries.popitem(last=False)
+                try:
+                    os.remove(namespace.path(evicted))
+                except OSError:
+                    pass
+            namespace.matrix = None
+
+    def reset(self, cache_dir=None):
+        with self.lock:
+            self.cache_dir = cache_dir if cache_dir is not None else self.cache_dir
+            self.namespaces = {}
+            self.hits = self.semantic_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'entries': sum(len(namespace.entries) for namespace in self.namespaces.values())
+            }
+
+llm_cache = LLMCache(
+    os.getenv("LLM_CACHE_DIR", "cache/llm"),
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", "2048")),
+    threshold=float(os.getenv("LLM_CACHE_THRESHOLD", "0.95"))
+)
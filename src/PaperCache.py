@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from src.util import write_file
+
+class PaperCache:
+    def __init__(self, cache_dir, query_ttl=3600):
+        self.cache_dir = cache_dir
+        self.query_ttl = query_ttl
+        os.makedirs(os.path.join(self.cache_dir, "papers"), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, "queries"), exist_ok=True)
+
+    def paper_dir(self, arxiv_id):
+        # Old-style identifiers such as hep-th/9901001v1 contain a slash
+        return os.path.join(self.cache_dir, "papers", arxiv_id.replace("/", "_"))
+
+    def query_path(self, keyword, k_articles):
+        key = hashlib.sha256(f"{keyword}\0{k_articles}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "queries", f"{key}.json")
+
+    def load_query(self, keyword, k_articles):
+        try:
+            with open(self.query_path(keyword, k_articles), "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - cached["fetched_at"] > self.query_ttl:
+            return None
+        return cached["articles"]
+
+    def save_query(self, keyword, k_articles, articles):
+        self.write_json(self.query_path(keyword, k_articles), {
+            'keyword': keyword,
+            'fetched_at': time.time(),
+            'articles': articles
+        })
+
+    def load_paper(self, arxiv_id):
+        if not arxiv_id:
+            return None
+
+        paper_dir = self.paper_dir(arxiv_id)
+        try:
+            with open(os.path.join(paper_dir, "chunks.json"), "r") as f:
+                chunks = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            embeddings = np.load(os.path.join(paper_dir, "embeddings.npy"))
+        except (OSError, ValueError):
+            embeddings = None
+
+        if embeddings is not None and len(embeddings) != len(chunks):
+            embeddings = None
+        return {'chunks': chunks, 'embeddings': embeddings}
+
+    def load_text(self, arxiv_id):
+        try:
+            with open(os.path.join(self.paper_dir(arxiv_id), "text.txt"), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save_paper(self, arxiv_id, text, chunks):
+        if not arxiv_id:
+            return
+
+        paper_dir = self.paper_dir(arxiv_id)
+        os.makedirs(paper_dir, exist_ok=True)
+        write_file(os.path.join(paper_dir, "text.txt"), lambda f: f.write(text.encode("utf-8")))
+        self.write_json(os.path.join(paper_dir, "chunks.json"), chunks)
+
+    def save_embeddings(self, arxiv_id, embeddings):
+        if not arxiv_id:
+            return
+
+        paper_dir = self.paper_dir(arxiv_id)
+        os.makedirs(paper_dir, exist_ok=True)
+        write_file(os.path.join(paper_dir, "embeddings.npy"), lambda f: np.save(f, np.asarray(embeddings, dtype='float32')))
+
+    def write_json(self, path, data):
+        write_file(path, lambda f: f.write(json.dumps(data).encode("utf-8")))
@@ -1,22 +1,49 @@
-def ranking(chunks, k=7):
-    counterlist = [chunk["metadata"]["title"] for chunk in chunks]
+import heapq
+from collections import Counter
+from src.Tracing import annotate, traced
 
-    for chunk in chunks:
-        chunk["repeat_count"] = counterlist.count(chunk["metadata"]["title"])
+# score = repeat * title repeats + match * graph matches + score * best FAISS similarity
+#       + rrf * sum over subqueries of rrf_k / (rrf_k + rank + 1)
+DEFAULT_WEIGHTS = {
+    "repeat": 0.7,
+    "match": 0.3,
+    "score": 1.0,
+    "rrf": 1.0,
+    "rrf_k": 60
+}
+
+@traced("ranking")
+def ranking(chunks, k=7, weights=None):
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    rrf_k = weights["rrf_k"]
+    repeat_counts = Counter(chunk["metadata"]["title"] for chunk in chunks)
 
     unique_chunks = {}
     
     for chunk in chunks:
         title = chunk["metadata"]["title"]
+        score = chunk.get("score", 0.0)
         
-        if title not in unique_chunks or chunk["repeat_count"] > unique_chunks[title]["repeat_count"]:
+        if title not in unique_chunks or score > unique_chunks[title]["score"]:
+            previous = unique_chunks.get(title)
             unique_chunks[title] = {
                 "metadata": chunk["metadata"],
+                "chunk_id": chunk.get("chunk_id"),
                 "chunk_text": chunk.get("chunk_text", chunk.get("text", chunk.get("content", ""))),
-                "match_count": chunk.get("match_count", 0),
-                "repeat_count": chunk["repeat_count"]
+                "match_count": max(chunk.get("match_count", 0), previous["match_count"] if previous else 0),
+                "repeat_count": repeat_counts[title],
+                "score": score,
+                "rrf": previous["rrf"] if previous else 0.0
             }
+        else:
+            unique_chunks[title]["match_count"] = max(unique_chunks[title]["match_count"], chunk.get("match_count", 0))
+
+        if "rank" in chunk:
+            unique_chunks[title]["rrf"] += rrf_k / (rrf_k + chunk["rank"] + 1)
+
+    def fused_score(x):
+        return (weights["repeat"] * x["repeat_count"] + weights["match"] * x["match_count"]
+                + weights["score"] * x["score"] + weights["rrf"] * x["rrf"])
 
-    unique_chunks = list(unique_chunks.values())
-    unique_chunks.sort(key=lambda x: (0.7 * x["repeat_count"] + 0.3 * x["match_count"]), reverse=True)
-    return unique_chunks[:k]
\ No newline at end of file
+    annotate(chunks=len(chunks), unique_titles=len(unique_chunks), k=k)
+    return heapq.nlargest(k, unique_chunks.values(), key=fused_score)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+from src.Scheduler import scheduler
+from src.Tracing import annotate, traced, tracer
+
+class Refiner:
+    """Decides whether refining a low-scoring answer can pay off in time, runs it and keeps score of the outcomes"""
+    def __init__(self, threshold=0.7, mode="single", latency_budget=30.0, default_cost=6.0, similarity_ceiling=0.9,
+                 window=256, min_samples=20, probe_every=10):
+        self.threshold = threshold
+        # "single" assesses and rewrites in one call, "two_step" uses DrafterAgent.assess then draft, "off" never refines
+        self.mode = mode
+        self.latency_budget = latency_budget
+        self.default_cost = default_cost
+        self.similarity_ceiling = similarity_ceiling
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.gains = deque(maxlen=window)
+        self.counts = {}
+        self.history_skips = 0
+        self.lock = threading.Lock()
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    def span_name(self):
+        return "Evaluation.refine" if self.mode == "single" else "Evaluation.drafting"
+
+    def expected_cost(self):
+        # p95 of recent refinements, a fixed guess until there are any
+        summary = tracer.summary(self.span_name())
+        return summary['p95_ms'] / 1000 if 'p95_ms' in summary else self.default_cost
+
+    def skip_reason(self, evaluator, score, started):
+        if self.mode == "off":
+            return "disabled"
+        if self.latency_budget - (time.perf_counter() - started) < self.expected_cost():
+            return "budget"
+
+        # Only the two answer similarities can move, chunk-query similarity is fixed by retrieval
+        if (evaluator.chunk_query_similarity + 2 * self.similarity_ceiling) / 3 < self.threshold:
+            return "gap"
+
+        with self.lock:
+            gains = list(self.gains)
+        if len(gains) >= self.min_samples and self.threshold - score > np.percentile(gains, 90):
+            # Every few skips refine anyway, otherwise the recorded gains could never change
+            with self.lock:
+                self.history_skips += 1
+                probe = self.history_skips % self.probe_every == 0
+            if not probe:
+                return "history"
+        return None
+
+    def plan(self, evaluator, score, started):
+        """True when the answer should be refined, skips are recorded by reason"""
+        if score >= self.threshold:
+            return False
+        reason = self.skip_reason(evaluator, score, started)
+        if reason is not None:
+            self.count(f"skipped_{reason}")
+            annotate(refinement_skipped=reason)
+            return False
+        return True
+
+    @traced("Refinement")
+    def refine(self, evaluator, answer, score):
+        refine_call = evaluator.refine if self.mode == "single" else evaluator.drafting
+        try:
+            refined = scheduler.io.submit(refine_call, answer).result()
+        except Exception as e:
+            self.count("failed")
+            annotate(failed=True)
+            print(f"Refinement failed: {str(e)}")
+            return answer
+
+        new_score = scheduler.cpu.submit(evaluator.evaluate, refined).result() if refined != answer else score
+        gain = new_score - score
+        with self.lock:
+            self.gains.append(gain)
+        self.count("attempted")
+        if refined == answer:
+            self.count("unchanged")
+        if gain > 0:
+            self.count("improved")
+        if new_score >= self.threshold:
+            self.count("reached_threshold")
+        annotate(score=round(score, 4), refined_score=round(new_score, 4), gain=round(gain, 4))
+
+        if new_score < score:
+            # The better answer is kept, re-scored so the shown evaluation matches it
+            self.count("kept_original")
+            scheduler.cpu.submit(evaluator.evaluate, answer).result()
+            return answer
+        return refined
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+            gains = list(self.gains)
+        attempted = counts.get('attempted', 0)
+        stats = dict(counts)
+        stats['improved_rate'] = round(counts.get('improved', 0) / attempted, 3) if attempted else 0.0
+        stats['reached_threshold_rate'] = round(counts.get('reached_threshold', 0) / attempted, 3) if attempted else 0.0
+        if gains:
+            stats['mean_gain'] = round(float(np.mean(gains)), 4)
+            stats['p90_gain'] = round(float(np.percentile(gains, 90)), 4)
+        stats['latency'] = tracer.summary(self.span_name())
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        skipped = ", ".join(f"{key[8:]} {value}" for key, value in sorted(stats.items()) if key.startswith("skipped_")) or "none"
+        return (
+            f"Refinement ({self.mode}): {stats.get('attempted', 0)} attempted, {stats['improved_rate']:.0%} raised the score, "
+            f"{stats['reached_threshold_rate']:.0%} reached {self.threshold}, skipped: {skipped}"
+        )
+
+refiner = Refiner(
+    mode=os.getenv("REFINE_MODE", "single"),
+    latency_budget=float(os.getenv("REFINE_LATENCY_BUDGET_S", "30")),
+    default_cost=float(os.getenv("REFINE_DEFAULT_COST_S", "6")),
+    similarity_ceiling=float(os.getenv("REFINE_SIMILARITY_CEILING", "0.9"))
+)
@@ -0,0 +1,72 @@
+import threading
+import time
+
+class Resources:
+    def __init__(self):
+        self.loaders = {}
+        self.values = {}
+        self.timings = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.warm_up_thread = None
+        self.created_at = time.perf_counter()
+
+    def register(self, name, loader):
+        with self.lock:
+            self.loaders[name] = loader
+            self.locks[name] = threading.Lock()
+
+    def override(self, name, value):
+        # Install an already-built value, e.g. a local stand-in, without running the loader
+        with self.lock:
+            self.locks.setdefault(name, threading.Lock())
+            self.values[name] = value
+            self.timings[name] = 0.0
+
+    def get(self, name):
+        if name in self.values:
+            return self.values[name]
+
+        with self.locks[name]:
+            if name not in self.values:
+                start = time.perf_counter()
+                value = self.loaders[name]()
+                self.timings[name] = time.perf_counter() - start
+                self.values[name] = value
+        return self.values[name]
+
+    def is_loaded(self, name):
+        return name in self.values
+
+    def warm_up(self, names=None, background=True):
+        names = list(names or self.loaders)
+
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"Warm-up of {name} failed: {str(e)}")
+            print(self.startup_report())
+
+        if not background:
+            load_all()
+            return None
+
+        with self.lock:
+            if self.warm_up_thread is None:
+                self.warm_up_thread = threading.Thread(target=load_all, name="resource-warm-up", daemon=True)
+                self.warm_up_thread.start()
+        return self.warm_up_thread
+
+    def startup_report(self):
+        lines = ["Resource load times:"]
+        for name in self.loaders:
+            if name in self.timings:
+                lines.append(f"  {name}: {self.timings[name]:.2f}s")
+            else:
+                lines.append(f"  {name}: not loaded")
+        lines.append(f"  total: {sum(self.timings.values()):.2f}s, {time.perf_counter() - self.created_at:.2f}s since startup")
+        return "\n".join(lines)
+
+resources = Resources()
@@ -0,0 +1,146 @@
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from src.Tracing import Histogram
+
+class Pool:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queued = 0
+        self.wait = Histogram()
+
+    def get_executor(self):
+        # Created on first use and then shared by every request for the life of the process
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=f"{self.name}-pool",
+                    initializer=self.mark_worker
+                )
+            return self.executor
+
+    def mark_worker(self):
+        self.local.worker = True
+
+    def submit(self, fn, *args, **kwargs):
+        if getattr(self.local, 'worker', False):
+            # A worker blocking on its own pool deadlocks once every worker does it, so nested work runs inline
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        # Tasks run in a copy of the caller's context so request scopes and trace spans follow them
+        context = contextvars.copy_context()
+        with self.lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        future = self.get_executor().submit(self.run, context, time.perf_counter(), fn, args, kwargs)
+        future.add_done_callback(self.release_cancelled)
+        return future
+
+    def release_cancelled(self, future):
+        # A task cancelled while queued never reaches run
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def run(self, context, submitted, fn, args, kwargs):
+        self.wait.add(time.perf_counter() - submitted)
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return context.run(fn, *args, **kwargs)
+        except BaseException:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    def map(self, fn, iterable):
+        futures = [self.submit(fn, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def metrics(self):
+        with self.lock:
+            metrics = {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'peak_queued': self.peak_queued
+            }
+        wait = self.wait.summary()
+        metrics['wait_p50_ms'] = wait.get('p50_ms', 0.0)
+        metrics['wait_p95_ms'] = wait.get('p95_ms', 0.0)
+        return metrics
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+class Scheduler:
+    """I/O pool for LLM, Mongo and HTTP calls, CPU pool for encoding and PDF parsing"""
+    def __init__(self, io_workers=16, cpu_workers=2, torch_threads=None):
+        self.io = Pool("io", io_workers)
+        self.cpu = Pool("cpu", cpu_workers)
+        self.fixed_torch_threads = torch_threads
+        self.torch_threads = torch_threads or self.default_torch_threads(batched=False)
+
+    def default_torch_threads(self, batched):
+        cores = os.cpu_count() or 1
+        # Batched encodes all run on the one embedding batcher thread, which then gets every core.
+        # Otherwise every CPU worker can run a forward pass at once, so together they should not exceed the cores
+        return cores if batched else max(1, cores // self.cpu.max_workers)
+
+    def configure_torch(self, batched=False):
+        import torch
+        self.torch_threads = self.fixed_torch_threads or self.default_torch_threads(batched)
+        torch.set_num_threads(self.torch_threads)
+
+    def metrics(self):
+        return {'io': self.io.metrics(), 'cpu': self.cpu.metrics(), 'torch_threads': self.torch_threads}
+
+    def report(self):
+        lines = ["Scheduler pools:"]
+        for pool in (self.io, self.cpu):
+            metrics = pool.metrics()
+            lines.append(
+                f"  {pool.name}: {metrics['running']}/{metrics['max_workers']} running, {metrics['queued']} queued "
+                f"(peak {metrics['peak_queued']}), {metrics['completed']} completed, "
+                f"wait p50 {metrics['wait_p50_ms']:.2f} ms p95 {metrics['wait_p95_ms']:.2f} ms"
+            )
+        return "\n".join(lines)
+
+    def shutdown(self, wait=True):
+        self.io.shutdown(wait)
+        self.cpu.shutdown(wait)
+
+def default_cpu_workers():
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+scheduler = Scheduler(
+    io_workers=int(os.getenv("SCHEDULER_IO_WORKERS", "16")),
+    cpu_workers=int(os.getenv("SCHEDULER_CPU_WORKERS", str(default_cpu_workers()))),
+    torch_threads=int(os.getenv("SCHEDULER_TORCH_THREADS", "0")) or None
+)
@@ -1,4 +1,5 @@
 import urllib.parse
+from src.Tracing import annotate, traced
 
 class ScholarLink:
     def __init__(self, llm_output):
@@ -10,6 +11,7 @@ class ScholarLink:
         sources_section = self.llm_output.split("Sources")[-1].strip()
         return sources_section
     
+    @traced("ScholarLink")
     def extract_scholar_links(self):
         sources_section = self.llm_output_to_sources()
         sources = sources_section.split("\n")
@@ -19,5 +21,6 @@ class ScholarLink:
                 url = f"https://scholar.google.com/scholar?q={encoded_search_term}"
                 self.scholar_links.append(url)
         
+        annotate(links=max(len(self.scholar_links) - 1, 0))
         return self.scholar_links[1:]
 
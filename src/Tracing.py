@@ -0,0 +1,237 @@
+import inspect
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+
+current_span = ContextVar("current_span", default=None)
+
+class Span:
+    def __init__(self, name, trace, parent, attributes):
+        self.name = name
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self):
+        # Field names follow the OpenTelemetry span model so traces can be forwarded to a collector as is
+        return {
+            'traceId': self.trace.trace_id if self.trace is not None else None,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.start_ns + int((self.duration or 0) * 1e9),
+            'durationMs': round((self.duration or 0) * 1000, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.error} if self.error else {'code': 'OK'}
+        }
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {'traceId': self.trace_id, 'name': self.name, 'spans': [span.to_dict() for span in spans]}
+
+class Histogram:
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, error=False):
+        with self.lock:
+            self.samples.append(seconds * 1000)
+            self.count += 1
+            self.errors += int(error)
+
+    def summary(self):
+        with self.lock:
+            samples = list(self.samples)
+            count, errors = self.count, self.errors
+        if not samples:
+            return {'count': count, 'errors': errors}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {
+            'count': count,
+            'errors': errors,
+            'p50_ms': round(float(p50), 3),
+            'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3),
+            'max_ms': round(float(max(samples)), 3)
+        }
+
+class Tracer:
+    def __init__(self, window=1024, keep_traces=100, trace_file=None):
+        self.window = window
+        self.histograms = {}
+        self.traces = deque(maxlen=keep_traces)
+        self.trace_file = trace_file
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        # Listeners receive every finished span, e.g. to forward them to an exporter or a benchmark
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners.remove(listener)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = current_span.get()
+        span = Span(name, parent.trace if parent is not None else None, parent, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            reset_span(token)
+            span.finish()
+            self.record(span)
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        # Starts a new trace for one request, spans opened inside it (also in copied contexts) become its children
+        trace = Trace(name)
+        root = Span(name, trace, None, attributes)
+        token = current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            reset_span(token)
+            root.finish()
+            self.record(root)
+            self.export(trace)
+            print(f"{name} took {root.duration:.3f}s (trace {trace.trace_id})")
+
+    def record(self, span):
+        if span.trace is not None:
+            span.trace.add(span)
+        with self.lock:
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = Histogram(self.window)
+            listeners = list(self.listeners)
+        histogram.add(span.duration, error=span.error is not None)
+        for listener in listeners:
+            listener(span)
+
+    def export(self, trace):
+        trace_dict = trace.to_dict()
+        self.traces.append(trace_dict)
+        if self.trace_file:
+            with self.lock:
+                with open(self.trace_file, "a") as f:
+                    f.write(json.dumps(trace_dict, default=str) + "\n")
+
+    def summary(self, name):
+        with self.lock:
+            histogram = self.histograms.get(name)
+        return histogram.summary() if histogram is not None else {'count': 0, 'errors': 0}
+
+    def stats(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+    def recent_traces(self):
+        return list(self.traces)
+
+    def report(self):
+        lines = [f"{'span':<32}{'count':>7}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}"]
+        for name, summary in self.stats().items():
+            if 'p50_ms' in summary:
+                lines.append(f"{name:<32}{summary['count']:>7}{summary['p50_ms']:>11.2f}{summary['p95_ms']:>11.2f}{summary['p99_ms']:>11.2f}")
+        return "\n".join(lines)
+
+def reset_span(token):
+    try:
+        current_span.reset(token)
+    except ValueError:
+        # A generator closed from another context, e.g. by the garbage collector
+        pass
+
+def span(name, **attributes):
+    return tracer.span(name, **attributes)
+
+def wrap_in(func, open_span):
+    # Generators and coroutines keep their span open until they finish, not just until they are created
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            with open_span():
+                return (yield from func(*args, **kwargs))
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def coroutine_wrapper(*args, **kwargs):
+            with open_span():
+                return await func(*args, **kwargs)
+        return coroutine_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with open_span():
+            return func(*args, **kwargs)
+    return wrapper
+
+def traced(name, **attributes):
+    return lambda func: wrap_in(func, lambda: tracer.span(name, **attributes))
+
+def traced_request(name, **attributes):
+    return lambda func: wrap_in(func, lambda: tracer.trace(name, **attributes))
+
+def usage_attributes(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    return {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+
+def annotate(**attributes):
+    # Adds attributes to the innermost open span, a no-op outside of any span
+    active = current_span.get()
+    if active is not None:
+        active.set(**attributes)
+
+tracer = Tracer(
+    window=int(os.getenv("TRACE_WINDOW", "1024")),
+    trace_file=os.getenv("TRACE_FILE")
+)
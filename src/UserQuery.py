@@ -1,13 +1,21 @@
-from openai import AzureOpenAI
+from src.EmbeddingService import get_embedding_service
+from src.LLMCache import llm_cache
+from src.Tracing import annotate, traced, usage_attributes
 
 class UserQuery:
-    def __init__(self, query: str, client, deployment):
+    # Bump whenever messages() changes so subqueries cached for the old prompt are not reused
+    prompt_version = 1
+
+    def __init__(self, query: str, client, deployment, model=None):
         self.query = query
         self.multi_queries = None
         self.client = client
         self.deployment = deployment
+        self.temperature = 0.5
+        # Near-identical questions only reuse cached subqueries when a model is given to compare them
+        self.model = model
 
-    def multi_query(self):
+    def messages(self):
 
         prompt = f"""
         You are a helpful assistant specialized in medical diagnostic devices.
@@ -22,17 +30,40 @@ class UserQuery:
 
         Return the output as a list of 3 subqueries only with no punctuation or numbering. Just have the questions in separate lines.
         """
+        return [
+            {"role": "system", "content": "You are an expert in breaking down complex medical device queries into simpler subqueries."},
+            {"role": "user", "content": prompt}
+        ]
+
+    def cache_scope(self):
+        return {'prompt_version': self.prompt_version, 'deployment': self.deployment, 'temperature': self.temperature}
+
+    def cached(self):
+        """Returns (subqueries or None, query embedding or None)"""
+        subqueries = llm_cache.get("subqueries", self.cache_scope(), self.query)
+        if subqueries is not None or self.model is None:
+            return subqueries, None
+        embedding = get_embedding_service(self.model).encode(self.query)
+        return llm_cache.search("subqueries", self.cache_scope(), embedding), embedding
+
+    def remember(self, subqueries, embedding=None):
+        llm_cache.put("subqueries", self.cache_scope(), self.query, subqueries, embedding)
+
+    @traced("UserQuery.multi_query")
+    def multi_query(self):
+        subqueries, embedding = self.cached()
+        if subqueries is not None:
+            self.multi_queries = subqueries
+            annotate(subqueries=len(subqueries), temperature=self.temperature, cached=True)
+            return self.multi_queries
+
         response = self.client.chat.completions.create(
             model=self.deployment,
-            messages=[
-                {"role": "system", "content": "You are an expert in breaking down complex medical device queries into simpler subqueries."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature= 0.5
+            messages=self.messages(),
+            temperature=self.temperature
         )
         output = response.choices[0].message.content
         self.multi_queries = output.split('\n')
+        self.remember(self.multi_queries, embedding)
+        annotate(subqueries=len(self.multi_queries), temperature=self.temperature, cached=False, **usage_attributes(response))
         return self.multi_queries
-
-
-        
\ No newline at end of file
@@ -1,95 +1,189 @@
 from src.UserQuery import UserQuery
-from sentence_transformers import SentenceTransformer
-from src.CacheHit import CacheHit
+from src.CacheHit import CacheHit, save_to_cache
 import faiss
-from src.ContextRetrieval import ContextRetrieval
+from src.ContextRetrieval import ContextRetrieval, get_nlp
 from src.Ranking import ranking
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 import json
-import networkx as nx
-from src.CacheDB import CacheDB
-from src.DeepSearch import DeepSearch
-from mongoengine import connect
+from src.DeepSearch import DeepSearch, load_nltk
+from src.PaperCache import PaperCache
+from src.Resources import resources
+from src.GraphStore import CSRGraph
+from src.CorpusStore import CorpusStore
+from src.EntityIndex import EntityIndex
+from src.CorpusPromoter import corpus_promoter, load_promoted_index
 import streamlit as st
 from src.ScholarLink import ScholarLink
 from src.Evaluation import Evaluation
-import concurrent.futures
-from datetime import datetime
-
-model = SentenceTransformer('pritamdeka/S-BioBert-snli-multinli-stsb', device='cpu')
-
-vector_db = faiss.read_index("data/chunks(1).index")
+from src.ContextBuilder import build_context
+from src.Refinement import refiner
+from src.EmbeddingService import register_embedding_service, with_request_scope
+from src.Tracing import annotate, span, traced_request
+from src.Scheduler import scheduler
+import os
+import time
 
 load_dotenv()
 
+model_name_or_path = 'pritamdeka/S-BioBert-snli-multinli-stsb'
+
 endpoint = "https://aoai-camp.openai.azure.com/"
 model_name = "gpt-4o-mini"
 deployment = "medical-device-research-model"
 api_version = "2024-12-01-preview"
 
-client = AzureOpenAI(
-            api_version=api_version,
-            azure_endpoint=endpoint,
-            api_key=st.secrets["AZURE_OPEN_AI_KEY"]
-)
-
-with open("data/chunks_with_entities(1).json", "r") as f:
-    dictionary = json.load(f)
-
-G = nx.read_gexf("data/knowledge_graph(3).gexf")
-
-connect(host=st.secrets["MONGO_URI"])
+# Only applied to index types that support them (IVF and HNSW)
+search_params = {
+    "nprobe": int(os.getenv("FAISS_NPROBE", "8")),
+    "ef_search": int(os.getenv("FAISS_EF_SEARCH", "64"))
+}
+
+# Opt-in: papers fetched by deep search are added to the corpus so normal search can answer from them
+promote_deep_search = os.getenv("PROMOTE_DEEP_SEARCH", "0") == "1"
+if promote_deep_search:
+    corpus_promoter.check_corpus()
+
+# Tokens of retrieved context sent with the answer and refinement prompts
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+
+# JSON object overriding entries of src.Ranking.DEFAULT_WEIGHTS, e.g. '{"rrf": 2.0}'
+ranking_weights = json.loads(os.getenv("RANKING_WEIGHTS", "{}"))
+
+def load_model():
+    from sentence_transformers import SentenceTransformer
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+    scheduler.configure_torch(batched=batch_size > 0)
+    model = SentenceTransformer(model_name_or_path, device='cpu')
+    register_embedding_service(
+        model,
+        model_name_or_path,
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")),
+        cache_dir=os.getenv("EMBEDDING_CACHE_DIR"),
+        max_batch_size=batch_size,
+        max_wait_ms=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+    )
+    return model
 
-def normal_search(input_query: str, temp=0.5):
-    start_time = datetime.now()
-    print("Starting normal search..." + datetime.now().strftime("%H:%M:%S.%f")[:-3])
-    def UserQuery_multi_query(input_query, client, deployment):
-        user_query = UserQuery(input_query, client, deployment)
-        return user_query.multi_query()
+def load_vector_db():
+    # FAISS_INDEX_TYPE selects a variant written by `python -m src.IndexBuilder`, "flat" is the shipped exact index
+    index_type = os.getenv("FAISS_INDEX_TYPE", "flat")
+    if index_type == "flat":
+        index_path = "data/chunks(1).index"
+    else:
+        index_path = os.path.join(os.getenv("FAISS_INDEX_DIR", "data/indexes"), f"{index_type}.index")
+
+    # Memory-map the index so worker processes share its pages instead of each holding a copy
+    io_flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    vector_db = faiss.read_index(index_path, io_flags)
+
+    # Promoted deep-search chunks live in a separate ID-mapped index, the base index stays read-only
+    promoted_index = os.getenv("PROMOTED_INDEX", "data/promoted.index")
+    if promote_deep_search or os.path.exists(promoted_index):
+        return load_promoted_index(vector_db, promoted_index)
+    return vector_db
+
+def load_paper_cache():
+    return PaperCache(
+        os.getenv("PAPER_CACHE_DIR", "cache/arxiv"),
+        query_ttl=int(os.getenv("PAPER_QUERY_TTL", "3600"))
+    )
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        cache_future = executor.submit(CacheHit, input_query, model)
-        user_query_future = executor.submit(UserQuery_multi_query, input_query, client, deployment)
+def load_client():
+    from openai import AzureOpenAI
+    return AzureOpenAI(
+                api_version=api_version,
+                azure_endpoint=endpoint,
+                api_key=st.secrets["AZURE_OPEN_AI_KEY"]
+    )
 
-        cache_result = cache_future.result()
-        subqueries = user_query_future.result()
+def load_dictionary():
+    # Prefer the columnar export written by `python -m src.CorpusStore`, fall back to the JSON list
+    corpus_dir = os.getenv("CORPUS_DIR", "data/corpus")
+    if os.path.exists(os.path.join(corpus_dir, "text_offsets.npy")):
+        return CorpusStore.load(corpus_dir)
+
+    with open("data/chunks_with_entities(1).json", "r") as f:
+        return json.load(f)
+
+def load_entity_index():
+    return EntityIndex.build(resources.get("dictionary"))
+
+def load_knowledge_graph():
+    # Prefer the CSR export written by `python -m src.GraphStore`, fall back to parsing the GEXF file
+    graph_dir = os.getenv("KNOWLEDGE_GRAPH_DIR", "data/knowledge_graph")
+    if os.path.exists(os.path.join(graph_dir, "offsets.npy")):
+        return CSRGraph.load(graph_dir)
+
+    import networkx as nx
+    return nx.read_gexf("data/knowledge_graph(3).gexf")
+
+def connect_mongo():
+    from mongoengine import connect
+    from src.CacheDB import CacheDB
+    connection = connect(host=st.secrets["MONGO_URI"])
+    CacheDB.ensure_schema()
+    return connection
+
+# Registration order is the warm-up order: what a cache hit needs comes first
+resources.register("model", load_model)
+resources.register("mongo", connect_mongo)
+resources.register("client", load_client)
+resources.register("vector_db", load_vector_db)
+resources.register("dictionary", load_dictionary)
+resources.register("entity_index", load_entity_index)
+resources.register("knowledge_graph", load_knowledge_graph)
+resources.register("nlp", get_nlp)
+resources.register("paper_cache", load_paper_cache)
+resources.register("nltk", load_nltk)
+
+def warm_up(background=True):
+    return resources.warm_up(background=background)
+
+def stage(message):
+    return {"type": "stage", "message": message}
+
+def stream_completion(client, messages, temp):
+    with span("LLM.completion", deployment=deployment, temperature=temp, stream=True) as completion_span:
+        response = client.chat.completions.create(
+            model=deployment,
+            messages=messages,
+            temperature=temp,
+            stream=True
+        )
+        tokens = 0
+        for chunk in response:
+            # Azure sends a first chunk with no choices that only carries content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                if tokens == 0:
+                    completion_span.set(first_token_ms=round((time.perf_counter() - completion_span.start) * 1000, 3))
+                tokens += 1
+                yield chunk.choices[0].delta.content
+        completion_span.set(tokens=tokens)
+
+def final_answer(events):
+    answer = ""
+    for event in events:
+        if event["type"] == "answer":
+            answer = event["text"]
+    return answer
 
-        if cache_result is not False:
-            return cache_result
+def format_context(chunks, query, model):
+    return build_context(chunks, query, model, budget=context_token_budget)
 
+def merge_retrievals(results):
     full_context = []
     disclaimers = []
+    for context, disclaimer in results:
+        disclaimers.append(disclaimer)
+        full_context.extend(context)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(ContextRetrieval(model, G, vector_db, dictionary, subquery).retrieve): subquery for subquery in subqueries}
-        for future in concurrent.futures.as_completed(futures):
-            context, disclaimer = future.result()
-            if disclaimer != "":
-                disclaimers.append(disclaimer)
-            for con in context:
-                full_context.append(con)
-
-    if "" in disclaimers:
-        disclaimer = "No disclaimer"
-    else:
-        disclaimer = disclaimers[0]
-    
-    rankings = ranking(full_context, k=10)
-
-    formatted_context = ""
-    for i, chunk in enumerate(rankings, 1):
-        metadata = chunk["metadata"]
-        content = chunk["chunk_text"]
-        
-        metadata_str = ""
-        for key, value in metadata.items():
-            metadata_str += f"{key}: {value}, "
-        metadata_str = metadata_str.rstrip(", ")
-        
-        formatted_context += f"[{i}] Metadata: {metadata_str}\nContent: {content}\n\n"
+    # The disclaimer is only needed when no subquery found graph-matched chunks
+    if "" in disclaimers or not disclaimers:
+        return full_context, "No disclaimer"
+    return full_context, disclaimers[0]
 
-    prompt = f"""
+def normal_prompt(formatted_context, input_query, disclaimer):
+    return f"""
 You are a helpful AI assistant. Use the provided context to answer the user's question accurately and comprehensively.
 
 Context:
@@ -108,23 +202,14 @@ Instructions:
 - If there is a disclaimer, mention it in your answer. Put the disclaimer before the sources.
 
 Answer:"""
-    response = client.chat.completions.create(
-        model=deployment,
-        messages=[
-            {"role": "system", "content": "You are an expert in literature review for medical diagnostics devices."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=temp
-    )
-    
-    answer = response.choices[0].message.content.strip()
-    
-    evaluator = Evaluation(rankings, input_query, model, client)
-    initial_metrics = evaluator.evaluate(answer)
-    if initial_metrics < 0.7:
-        answer = evaluator.drafting(answer)
-        evaluator.evaluate(answer)
 
+def answer_messages(prompt):
+    return [
+        {"role": "system", "content": "You are an expert in literature review for medical diagnostics devices."},
+        {"role": "user", "content": prompt}
+    ]
+
+def add_links_and_scores(answer, evaluator):
     evaluation_text = evaluator.format_evaluation_results()
 
     counter = 1
@@ -132,57 +217,117 @@ Answer:"""
     for link in links:
         answer += f"\n\n [{counter}] {link}"
         counter += 1
+
+    return answer + evaluation_text
+
+def normal_search(input_query: str, temp=0.5):
+    return final_answer(normal_search_stream(input_query, temp))
+
+@with_request_scope
+@traced_request("normal_search")
+def normal_search_stream(input_query: str, temp=0.5):
+    started = time.perf_counter()
+    annotate(query_chars=len(input_query), temperature=temp)
+    model = resources.get("model")
+    client = resources.get("client")
+    resources.get("mongo")
+    yield stage("Checking the cache and creating subqueries from your query...")
+
+    def UserQuery_multi_query(input_query, client, deployment):
+        user_query = UserQuery(input_query, client, deployment, model=model)
+        return user_query.multi_query()
+
+    cache_future = scheduler.cpu.submit(CacheHit, input_query, model)
+    user_query_future = scheduler.io.submit(UserQuery_multi_query, input_query, client, deployment)
+
+    # Retrieval on the raw query starts while the subqueries are still being generated
+    vector_db = resources.get("vector_db")
+    retriever = ContextRetrieval(model, resources.get("knowledge_graph"), vector_db, resources.get("dictionary"), entity_index=resources.get("entity_index"), search_params=search_params)
+    speculative_future = scheduler.cpu.submit(retriever.retrieve_batch, [input_query])
+
+    cache_result = cache_future.result()
+    annotate(cache_hit=cache_result is not False)
+    if cache_result is not False:
+        # A hit does not wait for the subqueries or the retrieval, both are dropped if they have not started yet
+        user_query_future.cancel()
+        speculative_future.cancel()
+        yield {"type": "answer", "text": cache_result}
+        return
+    subqueries = user_query_future.result()
+
+    yield stage("Searching the vector DB and knowledge graph for each subquery...")
+    subquery_future = scheduler.cpu.submit(retriever.retrieve_batch, subqueries)
+    full_context, disclaimer = merge_retrievals(speculative_future.result() + subquery_future.result())
+    
+    yield stage("Ranking by match count and semantic relevance...")
+    rankings = ranking(full_context, k=10, weights=ranking_weights)
+
+    formatted_context = scheduler.cpu.submit(format_context, rankings, input_query, model).result()
+
+    prompt = normal_prompt(formatted_context, input_query, disclaimer)
+    yield stage("Generating the answer...")
+    answer = ""
+    for token in stream_completion(client, answer_messages(prompt), temp):
+        answer += token
+        yield {"type": "token", "text": token}
+    answer = answer.strip()
     
-    answer += evaluation_text
+    evaluator = Evaluation(rankings, input_query, model, client, vector_db=vector_db, context=formatted_context)
+    yield stage("Evaluating the results...")
+    initial_metrics = scheduler.cpu.submit(evaluator.evaluate, answer).result()
+    # Skipped when the request is close to its latency budget or the score gap cannot be closed
+    if refiner.plan(evaluator, initial_metrics, started):
+        yield stage("Refining the answer against the retrieved context...")
+        answer = refiner.refine(evaluator, answer, initial_metrics)
 
-    CacheDB(
-        query=input_query,
-        answer=answer,
-        tag="normal"
-    ).save()
+    answer = add_links_and_scores(answer, evaluator)
 
-    print("Finished normal search..." + datetime.now().strftime("%H:%M:%S.%f")[:-3])
-    end_time = datetime.now()
-    print(f"Normal search duration: {end_time - start_time}")
+    # Only queues the write, src.CacheWriter persists it in the background
+    save_to_cache(input_query, answer, "normal", model)
 
-    return answer
+    yield {"type": "answer", "text": answer}
     
 # result = normal_search("What is the best sugar monitoring device?")
 # print(result)
 
 def deep_search(input_query: str, temp: float):
-    start_time = datetime.now()
-    print("Starting deep search..." + datetime.now().strftime("%H:%M:%S.%f")[:-3])
-    user_query = UserQuery(input_query, client, deployment)
+    return final_answer(deep_search_stream(input_query, temp))
+
+@with_request_scope
+@traced_request("deep_search")
+def deep_search_stream(input_query: str, temp: float):
+    started = time.perf_counter()
+    annotate(query_chars=len(input_query), temperature=temp)
+    model = resources.get("model")
+    client = resources.get("client")
+    vector_db = resources.get("vector_db")
+    resources.get("mongo")
+
+    yield stage("Creating subqueries from your query...")
+    user_query = UserQuery(input_query, client, deployment, model=model)
     subqueries = user_query.multi_query()
     full_context = []
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        deep_searcher_future = executor.submit(DeepSearch(input_query, model, k_articles=5, k_chunks=7).get_context)
-        futures = {executor.submit(ContextRetrieval(model, G, vector_db, dictionary, subquery, k=30).retrieve): subquery for subquery in subqueries}
-        
-        chunks = deep_searcher_future.result()
+    yield stage("Fetching arXiv papers and searching the vector DB and knowledge graph...")
 
-        for future in concurrent.futures.as_completed(futures):
-            context, disclaimer = future.result()
-            for con in context:
+    retrieval_future = scheduler.cpu.submit(ContextRetrieval(model, resources.get("knowledge_graph"), vector_db, resources.get("dictionary"), k=30, entity_index=resources.get("entity_index"), search_params=search_params).retrieve_batch, subqueries)
+    # DeepSearch coordinates its own downloads and parses on the scheduler pools, so it runs on this thread
+    searcher = DeepSearch(input_query, model, k_articles=5, k_chunks=7, paper_cache=resources.get("paper_cache"))
+    chunks = searcher.get_context()
+
+    # Promoted papers can also come back from the vector DB, the arXiv copy is already in the context
+    deep_texts = {chunk['chunk_text'] for chunk in chunks}
+    for context, disclaimer in retrieval_future.result():
+        for con in context:
+            if con['chunk_text'] not in deep_texts:
                 full_context.append(con)
 
-    rankings = ranking(full_context, k=3)
+    yield stage("Ranking by match count and semantic relevance...")
+    rankings = ranking(full_context, k=3, weights=ranking_weights)
 
     final_context = chunks + rankings
 
-    formatted_context = ""
-    for i, chunk in enumerate(final_context, 1):
-        metadata = chunk["metadata"]
-        content = chunk["chunk_text"]
-        
-        metadata_str = ""
-        for key, value in metadata.items():
-            metadata_str += f"{key}: {value}, "
-        metadata_str = metadata_str.rstrip(", ")
-        
-        formatted_context += f"[{i}] Metadata: {metadata_str}\nContent: {content}\n\n"
+    formatted_context = scheduler.cpu.submit(format_context, final_context, input_query, model).result()
 
     prompt = f"""
 You are a helpful AI assistant. Use the provided context to answer the user's question accurately and comprehensively.
@@ -199,44 +344,37 @@ Instructions:
 - Provide a clear, well-structured answer
 
 Answer:"""
-    response = client.chat.completions.create(
-        model=deployment,
-        messages=[
-            {"role": "system", "content": "You are an expert in literature review for medical diagnostics devices."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature= temp
-    )
+    yield stage("Generating the answer...")
+    answer = ""
+    for token in stream_completion(client, answer_messages(prompt), temp):
+        answer += token
+        yield {"type": "token", "text": token}
+    answer = answer.strip()
+
+    evaluator = Evaluation(final_context, input_query, model, client, vector_db=vector_db, context=formatted_context)
+    yield stage("Evaluating the results...")
+    initial_metrics = scheduler.cpu.submit(evaluator.evaluate, answer).result()
+    # Skipped when the request is close to its latency budget or the score gap cannot be closed
+    if refiner.plan(evaluator, initial_metrics, started):
+        yield stage("Refining the answer against the retrieved context...")
+        answer = refiner.refine(evaluator, answer, initial_metrics)
+
+    answer = add_links_and_scores(answer, evaluator)
     
-    answer = response.choices[0].message.content.strip()
+    # Only queues the write, src.CacheWriter persists it in the background
+    save_to_cache(input_query, answer, "deep", model)
 
-    evaluator = Evaluation(final_context, input_query, model, client)
-    initial_metrics = evaluator.evaluate(answer)
-    if initial_metrics < 0.7:
-        answer = evaluator.drafting(answer)
-        evaluator.evaluate(answer)
+    if promote_deep_search:
+        # Runs after the answer is ready and does not hold up the response
+        scheduler.cpu.submit(promote_papers, searcher.papers)
 
-    evaluation_text = evaluator.format_evaluation_results()
+    yield {"type": "answer", "text": answer}
 
-    counter = 1
-    links = ScholarLink(answer).extract_scholar_links()
-    for link in links:
-        answer += f"\n\n [{counter}] {link}"
-        counter += 1
-
-    answer += evaluation_text
-    
-    CacheDB(
-        query=input_query,
-        answer=answer,
-        tag="deep"
-    ).save()
-
-    print("Finished deep search..." + datetime.now().strftime("%H:%M:%S.%f")[:-3])
-    end_time = datetime.now()
-    print(f"Deep search duration: {end_time - start_time}")
-
-    return answer
+def promote_papers(papers):
+    try:
+        corpus_promoter.promote(papers)
+    except Exception as e:
+        print(f"Promotion of deep search papers failed: {str(e)}")
 
 # result = deep_search("What is the best sugar monitoring device?")
 # print(result)
@@ -1,4 +1,19 @@
+import os
+import threading
 import numpy as np
 
 def cosine_similarity(vec1, vec2):
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
\ No newline at end of file
+    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+
+def write_file(path, write):
+    """Writes through write(f) to a temp file, then renames it over path so readers never see a partial file"""
+    # The temp name is unique per process and thread, so concurrent writers of the same path cannot clobber each other
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
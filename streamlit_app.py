@@ -1,6 +1,7 @@
 import streamlit as st
+import html
 import time
-from src.main import normal_search, deep_search
+from src.main import normal_search_stream, deep_search_stream, warm_up
 
 st.set_page_config(
     page_title="Medical Diagnostic Device Research",
@@ -9,6 +10,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Load models and indexes in the background so the first query does not pay for all of them
+warm_up()
+
 # ---- Session State ----
 if "dark_mode" not in st.session_state:
     st.session_state.dark_mode = False
@@ -302,10 +306,6 @@ with st.sidebar:
         st.session_state.search_result = ""
         st.session_state.result_shown = False
         st.session_state.loading = False
-        # Reset typing animation states
-        st.session_state.typing_complete = False
-        st.session_state.typing_position = 0
-        st.session_state.typing_active = False
 
 # ---- Title & Greeting ----
 st.markdown("<div class='title'>Medical Diagnostic Device Research</div>", unsafe_allow_html=True)
@@ -330,47 +330,6 @@ if col_deep[0].button(deep_search_label, key="deep_search_btn", help="Toggle dee
     st.session_state.deep_search = not st.session_state.deep_search
     st.rerun()
 
-# ---- Search Action ----
-if submitted and st.session_state.search_query.strip():
-    # Reset typing state when starting a new search
-    st.session_state.typing_complete = False
-    st.session_state.typing_position = 0
-    st.session_state.typing_active = False
-    
-    st.session_state.loading = True
-    st.session_state.result_shown = False
-    loader_area = st.empty()
-    message_area = st.empty()
-
-    loader_area.markdown('<div class="loader"></div>', unsafe_allow_html=True)
-
-    steps = [
-        "Creating subqueries from your query...",
-        "Searching vector DB for each subquery...",
-        "Running Graph-RAG and collecting related nodes...",
-        "Feeding context into the LLM...",
-        "Cross-checking intersections between retrieved articles...",
-        "Ranking by match count and semantic relevance...",
-        "Evaluating the results...",
-    ]
-
-    for step in steps:
-        message_area.markdown(f"<p style='text-align:center; font-size:1.05rem;'>{step}</p>", unsafe_allow_html=True)
-        time.sleep(1.1)
-
-    loader_area.empty()
-    message_area.empty()
-
-    if st.session_state.deep_search:
-        result = deep_search(st.session_state.search_query, st.session_state.temperature)
-    else:
-        result = normal_search(st.session_state.search_query, st.session_state.temperature)
-    
-    st.session_state.search_result = result
-    st.session_state.loading = False
-    st.session_state.result_shown = True
-    st.rerun()  # Force rerun to display results with clean state
-
 # Add typing animation CSS
 st.markdown("""
     <style>
@@ -451,7 +410,64 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# ---- Display Result with Typing Animation ----
+# ---- Result Rendering ----
+def render_result(container, text, cursor=False):
+    # Answers are model output, escaped so they render as text and not as HTML
+    text = html.escape(text) + ("█" if cursor else "")
+    if st.session_state.dark_mode:
+        container.markdown(
+            f'<div class="typing-container" style="background-color: #1e1e1e !important; color: #FAFAFA !important; border: 1px solid #444; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
+            f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #FAFAFA !important; opacity: 1 !important;">{text}</div>'
+            f'</div>',
+            unsafe_allow_html=True
+        )
+    else:
+        container.markdown(
+            f'<div class="typing-container" style="background-color: #f8f9fa !important; color: #333333 !important; border: 1px solid #e9ecef; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
+            f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #333333 !important; opacity: 1 !important;">{text}</div>'
+            f'</div>',
+            unsafe_allow_html=True
+        )
+
+# ---- Search Action ----
+if submitted and st.session_state.search_query.strip():
+    st.session_state.loading = True
+    st.session_state.result_shown = False
+    loader_area = st.empty()
+    message_area = st.empty()
+    result_container = st.empty()
+
+    loader_area.markdown('<div class="loader"></div>', unsafe_allow_html=True)
+
+    search = deep_search_stream if st.session_state.deep_search else normal_search_stream
+    streamed_text = ""
+    rendered_at = 0.0
+    result = ""
+
+    # Stage messages and LLM tokens are rendered as the pipeline produces them,
+    # tokens at most every 50 ms since each render sends the whole text so far
+    for event in search(st.session_state.search_query, st.session_state.temperature):
+        if event["type"] == "stage":
+            message_area.markdown(f"<p style='text-align:center; font-size:1.05rem;'>{event['message']}</p>", unsafe_allow_html=True)
+        elif event["type"] == "token":
+            streamed_text += event["text"]
+            if time.monotonic() - rendered_at >= 0.05:
+                loader_area.empty()
+                render_result(result_container, streamed_text, cursor=True)
+                rendered_at = time.monotonic()
+        elif event["type"] == "answer":
+            result = event["text"]
+
+    loader_area.empty()
+    message_area.empty()
+    result_container.empty()
+    
+    st.session_state.search_result = result
+    st.session_state.loading = False
+    st.session_state.result_shown = True
+    st.rerun()  # Force rerun to display results with clean state
+
+# ---- Display Result ----
 if st.session_state.result_shown and st.session_state.search_result and not submitted:
     # Force bright styling on the success message
     st.markdown("""
@@ -471,90 +487,4 @@ if st.session_state.result_shown and st.session_state.search_result and not subm
     """, unsafe_allow_html=True)
     
     st.success(f"Results for: **{st.session_state.search_query}**")
-    
-    # Initialize typing state variables
-    if "typing_position" not in st.session_state:
-        st.session_state.typing_position = 0
-    if "typing_complete" not in st.session_state:
-        st.session_state.typing_complete = False
-    if "typing_active" not in st.session_state:
-        st.session_state.typing_active = False
-    
-    # Get the result text
-    result_text = st.session_state.search_result
-    
-    # Create container for typing animation
-    result_container = st.empty()
-    
-    # Start typing animation only if not already started
-    if not st.session_state.typing_active and not st.session_state.typing_complete:
-        st.session_state.typing_active = True
-        st.session_state.typing_position = 0
-        st.rerun()  # Trigger immediate rerun to start animation
-    
-    # Animation in progress
-    elif st.session_state.typing_active and st.session_state.typing_position < len(result_text):
-        # Show text up to current position with cursor
-        typed_text = result_text[:st.session_state.typing_position]
-        display_text = typed_text + "█"  # Using block cursor
-        
-        # Apply appropriate styling based on dark mode
-        if st.session_state.dark_mode:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #1e1e1e !important; color: #FAFAFA !important; border: 1px solid #444; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #FAFAFA !important; opacity: 1 !important;">{display_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-        else:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #f8f9fa !important; color: #333333 !important; border: 1px solid #e9ecef; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #333333 !important; opacity: 1 !important;">{display_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-        
-        # Advance typing position - much faster now
-        st.session_state.typing_position += 12  # Type 12 characters at a time for faster animation
-        
-        # Auto-advance the typing with minimal delay
-        time.sleep(0.005)  # Even smaller delay for typing effect
-        st.rerun()
-        
-    # Animation complete
-    elif st.session_state.typing_position >= len(result_text) and st.session_state.typing_active:
-        # Typing complete - show final text without cursor
-        st.session_state.typing_complete = True
-        st.session_state.typing_active = False
-        
-        if st.session_state.dark_mode:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #1e1e1e !important; color: #FAFAFA !important; border: 1px solid #444; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #FAFAFA !important; opacity: 1 !important;">{result_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-        else:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #f8f9fa !important; color: #333333 !important; border: 1px solid #e9ecef; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #333333 !important; opacity: 1 !important;">{result_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-    
-    # Animation already complete - just display the final result
-    elif st.session_state.typing_complete:
-        if st.session_state.dark_mode:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #1e1e1e !important; color: #FAFAFA !important; border: 1px solid #444; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #FAFAFA !important; opacity: 1 !important;">{result_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-        else:
-            result_container.markdown(
-                f'<div class="typing-container" style="background-color: #f8f9fa !important; color: #333333 !important; border: 1px solid #e9ecef; padding: 1.5rem; border-radius: 8px; opacity: 1 !important;">'
-                f'<div class="typing-text" style="font-family: \'Segoe UI\', sans-serif; line-height: 1.6; white-space: pre-wrap; word-wrap: break-word; color: #333333 !important; opacity: 1 !important;">{result_text}</div>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
+    render_result(st.empty(), st.session_state.search_result)